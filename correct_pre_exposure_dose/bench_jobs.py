@@ -0,0 +1,95 @@
+import os
+import io
+import time
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+from correct_pre_exposure_dose import update_all_star_files
+
+# Times update_all_star_files for different --jobs on a synthetic star and mdoc folder.
+# Make the folder on the storage you want to know about (--dir), the pool mostly helps
+# when every file takes a while to open, read and replace, as on networked storage.
+
+def write_mdoc(path, tilt_angles, exposure_dose):
+    with open(path, 'w') as f:
+        f.write("PixelSpacing = 1.0\n\n")
+        for z, angle in enumerate(tilt_angles):
+            f.write(f"[ZValue = {z}]\nTiltAngle = {angle + 0.01:.2f}\nPriorRecordDose = {z * exposure_dose:.3f}\n\n")
+
+def write_star(path, tomo_name, tilt_angles):
+    with open(path, 'w') as f:
+        f.write(f"\ndata_global\n\n_rlnTomoName {tomo_name}\n\ndata_{tomo_name}\n\nloop_\n"
+                "_rlnMicrographMovieName #1\n_rlnTomoTiltMovieFrameCount #2\n"
+                "_rlnTomoNominalStageTiltAngle #3\n_rlnTomoNominalTiltAxisAngle #4\n"
+                "_rlnMicrographPreExposure #5\n_rlnTomoNominalDefocus #6\n")
+        for z, angle in enumerate(tilt_angles):
+            f.write(f"frames/{tomo_name}_{z:03d}_{angle:.2f}.eer\t10\t{angle:.2f}\t-95.0\t0.0000\t-4.0\n")
+
+def make_folders(folder, n_tomograms, n_tilts, exposure_dose):
+    # A star and an mdoc folder with n_tomograms tomograms of n_tilts tilts, collected dose symmetric
+    star_folder, mdoc_folder = os.path.join(folder, 'star'), os.path.join(folder, 'mdoc')
+    os.makedirs(star_folder)
+    os.makedirs(mdoc_folder)
+    order = np.argsort(np.abs(np.arange(n_tilts) - n_tilts // 2), kind='stable')
+    tilt_angles = ((np.arange(n_tilts) - n_tilts // 2) * 3.0)[order]
+    for i in range(n_tomograms):
+        tomo_name = f"Position_{i + 1}"
+        write_mdoc(os.path.join(mdoc_folder, f"{tomo_name}.mdoc"), tilt_angles, exposure_dose)
+        write_star(os.path.join(star_folder, f"{tomo_name}.mrc.star"), tomo_name, tilt_angles)
+    return star_folder, mdoc_folder
+
+def folder_digest(folder):
+    sha = hashlib.sha256()
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.mrc.star'):
+            with open(os.path.join(folder, name), 'rb') as f:
+                sha.update(name.encode() + f.read())
+    return sha.hexdigest()
+
+def bench(folder, n_tomograms, n_tilts, exposure_dose, jobs, repeats):
+    # Best time of repeats runs on fresh star files (no manifest, no mdoc cache) and the digest of the output
+    times = []
+    for _ in range(repeats):
+        run_folder = tempfile.mkdtemp(dir=folder)
+        try:
+            star_folder, mdoc_folder = make_folders(run_folder, n_tomograms, n_tilts, exposure_dose)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summary = update_all_star_files(star_folder, mdoc_folder, exposure_dose, jobs=jobs)
+            times.append(time.perf_counter() - start)
+            if len(summary['updated']) != n_tomograms:
+                raise RuntimeError(f"only {len(summary['updated'])} of {n_tomograms} star files were updated")
+            digest = folder_digest(star_folder)
+        finally:
+            shutil.rmtree(run_folder)
+    return min(times), digest
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time correct_pre_exposure_dose.py for different --jobs on a synthetic folder")
+    parser.add_argument("--dir", default=None, help="Folder to make the synthetic star and mdoc files in (default: a temporary folder)")
+    parser.add_argument("--tomograms", type=int, default=400, help="Number of tomograms")
+    parser.add_argument("--tilts", type=int, default=61, help="Number of tilts per tomogram")
+    parser.add_argument("--exposure-dose", type=float, default=3.0, help="Exposure dose per tilt (e-/Å²)")
+    parser.add_argument("-j", "--jobs", type=int, nargs='+', default=[1, 2, 4, 8], help="Values of --jobs to time")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per value of --jobs, the fastest one is reported")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print(f"{args.tomograms} tomograms of {args.tilts} tilts in {folder}, {os.cpu_count()} CPUs")
+        results = {jobs: bench(folder, args.tomograms, args.tilts, args.exposure_dose, jobs, args.repeats)
+                   for jobs in args.jobs}
+    finally:
+        shutil.rmtree(folder)
+    serial = results.get(1, (None,))[0]
+    for jobs, (seconds, _) in results.items():
+        speedup = f", {serial / seconds:.2f}x the serial run" if serial else ""
+        print(f"--jobs {jobs}: {seconds:.2f} s{speedup}")
+    if len({digest for _, digest in results.values()}) != 1:
+        print("The star files differ between the values of --jobs")
+    else:
+        print("The star files are identical for all values of --jobs")
@@ -1,108 +1,434 @@
 import os
+import io
+import re
 import glob
+import json
+import shutil
+import hashlib
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 
-def parse_mdoc_tiltangle_prior_dose(mdoc_path):
+TILT_ANGLE_LABEL = '_rlnTomoNominalStageTiltAngle'
+PRE_EXPOSURE_LABEL = '_rlnMicrographPreExposure'
+# Number of star file lines that are buffered before they are written out
+CHUNK_SIZE = 10000
+# Default size cap of the compiled mdoc cache, least recently used entries are removed beyond this
+MDOC_CACHE_SIZE = 64 * 1024**2
+# Record of the corrected star files, kept in the star folder
+MANIFEST_NAME = '.pre_exposure_manifest.json'
+# A value in a star data row: quoted (the closing quote is followed by whitespace) or anything up to whitespace
+STAR_VALUE = re.compile(r'"(?:[^"]|"(?!\s|$))*"(?=\s|$)' r"|'(?:[^']|'(?!\s|$))*'(?=\s|$)" r'|\S+')
+
+def parse_mdoc(mdoc_path):
+    """
+    Parse all per-tilt fields (the key = value lines of every [ZValue] section) of an mdoc file.
+    Returns a structured array with one record per ZValue and a field per mdoc key. Numeric keys
+    are floats with NaN where a tilt lacks the key, all other keys are strings.
+    """
+    sections = []
+    with open(mdoc_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                sections.append({} if line.startswith('[ZValue') else None)
+            elif '=' in line and sections and sections[-1] is not None:
+                key, value = line.split('=', 1)
+                sections[-1][key.strip()] = value.strip()
+    sections = [section for section in sections if section is not None]
+
+    fields = {}
+    for key in dict.fromkeys(key for section in sections for key in section):
+        values = [section.get(key, '') for section in sections]
+        try:
+            fields[key] = np.array([float(v) if v else np.nan for v in values])
+        except ValueError:
+            fields[key] = np.array(values, dtype=str)
+
+    tilts = np.empty(len(sections), dtype=[(key, values.dtype) for key, values in fields.items()])
+    for key, values in fields.items():
+        tilts[key] = values
+    return tilts
+
+def mdoc_cache_path(mdoc_path, cache_dir):
+    """
+    Path of the cache entry of an mdoc. The name includes the size and mtime of the mdoc,
+    so an edited mdoc never hits a stale entry.
+    """
+    stat = os.stat(mdoc_path)
+    key = f"{os.path.abspath(mdoc_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return os.path.join(cache_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.npy")
+
+def file_mode(path):
+    """
+    Permissions for a file written as a temporary file and moved to path: those of the file it replaces,
+    or what a newly created file gets (0666 minus the umask). tempfile makes its files 0600,
+    which other users of a shared project folder can't read.
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def read_mdoc_cached(mdoc_path, cache_dir, cache_size=MDOC_CACHE_SIZE):
+    """
+    parse_mdoc, but with the result stored as a compiled .npy in cache_dir.
+    """
+    cache_path = mdoc_cache_path(mdoc_path, cache_dir)
+    try:
+        tilts = np.load(cache_path)
+        # the entry mtime tracks its last use for the LRU pruning
+        os.utime(cache_path)
+        return tilts
+    except (OSError, ValueError):
+        pass  # missing or unreadable entry, parse the mdoc
+
+    tilts = parse_mdoc(mdoc_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+        np.save(f, tilts)
+    os.chmod(f.name, file_mode(cache_path))
+    os.replace(f.name, cache_path)
+    prune_mdoc_cache(cache_dir, cache_size)
+    return tilts
+
+def prune_mdoc_cache(cache_dir, cache_size=MDOC_CACHE_SIZE):
+    """
+    Remove the least recently used entries from cache_dir until it holds at most cache_size bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another worker
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+def parse_mdoc_tiltangle_prior_dose(mdoc_path, cache_dir=None, cache_size=MDOC_CACHE_SIZE):
     """
     Parse mdoc file to extract TiltAngle and PriorRecordDose per tilt.
+    If a cache_dir is given the compiled mdoc is read from, or stored in, that folder.
     Returns a list of tuples: (tilt_angle, prior_record_dose)
     """
-    tilt_doses = []
-    tilt_angle = None
-    prior_dose = None
-
     try:
-        with open(mdoc_path, 'r') as f:
-            lines = f.readlines()
+        tilts = parse_mdoc(mdoc_path) if cache_dir is None else read_mdoc_cached(mdoc_path, cache_dir, cache_size)
     except FileNotFoundError:
         print(f"Warning: MDOC file not found: {mdoc_path}")
-        return tilt_doses  # Return empty list, skip file later
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith('[ZValue'):
-            tilt_angle = None
-            prior_dose = None
-        elif line.startswith('TiltAngle'):
-            tilt_angle = float(line.split('=')[1].strip())
-        elif line.startswith('PriorRecordDose'):
-            prior_dose = float(line.split('=')[1].strip())
-            if tilt_angle is not None and prior_dose is not None:
-                tilt_doses.append((tilt_angle, prior_dose))
-
-    return tilt_doses
-
-def find_closest_dose(tilt_angle, tilt_doses):
-    if not tilt_doses:
-        return None
-    closest = min(tilt_doses, key=lambda x: abs(x[0] - tilt_angle))
-    return closest[1]
+        return []  # Return empty list, skip file later
+    if not {'TiltAngle', 'PriorRecordDose'} <= set(tilts.dtype.names or ()):
+        return []
+    tilt_angles = tilts['TiltAngle'].astype(float)
+    prior_doses = tilts['PriorRecordDose'].astype(float)
+    valid = ~(np.isnan(tilt_angles) | np.isnan(prior_doses))
+    return list(zip(tilt_angles[valid].tolist(), prior_doses[valid].tolist()))
 
-def update_star_file(star_file, mdoc_folder, exposure_dose):
+def build_dose_index(tilt_doses):
     """
-    Update one STAR file using its corresponding MDOC file from a different folder.
+    Turn the (tilt_angle, prior_record_dose) tuples of an mdoc into a lookup index.
+    Returns two arrays: the tilt angles sorted ascending and their prior doses.
     """
-    base_name = os.path.basename(star_file)
-    tomo_base = base_name.replace('.mrc.star', '')
-    mdoc_path = os.path.join(mdoc_folder, f"{tomo_base}.mdoc")
+    tilt_doses = np.asarray(tilt_doses, dtype=float).reshape(-1, 2)
+    order = np.argsort(tilt_doses[:, 0], kind='stable')
+    return tilt_doses[order, 0], tilt_doses[order, 1]
 
-    tilt_doses = parse_mdoc_tiltangle_prior_dose(mdoc_path)
-    if not tilt_doses:
-        print(f"Skipping {star_file}: No valid data from {mdoc_path}")
-        return
+def find_closest_doses(tilt_angles, dose_index, tolerance=None):
+    """
+    Look up the prior dose of the closest mdoc tilt for a whole column of tilt angles.
+    Returns the prior doses and a boolean mask that is False for tilt angles without
+    an mdoc tilt within tolerance (degrees). Without a tolerance everything matches.
+    """
+    index_angles, index_doses = dose_index
+    tilt_angles = np.asarray(tilt_angles, dtype=float)
+    # candidates are the mdoc tilts directly above and below each angle
+    right = np.clip(np.searchsorted(index_angles, tilt_angles), 0, len(index_angles) - 1)
+    left = np.clip(right - 1, 0, len(index_angles) - 1)
+    left_diff = np.abs(index_angles[left] - tilt_angles)
+    right_diff = np.abs(index_angles[right] - tilt_angles)
+    closest = np.where(left_diff <= right_diff, left, right)
+    matched = np.minimum(left_diff, right_diff) <= tolerance if tolerance is not None \
+        else np.ones(tilt_angles.shape, dtype=bool)
+    return index_doses[closest], matched
 
-    print(f"Processing {star_file} using {mdoc_path}...")
+def read_star_tilt_rows(star_handle):
+    """
+    Stream a STAR file line by line, resolving the tilt angle and pre-exposure columns
+    from the loop header of every data block.
+    Yields tuples: (line, cols, tilt_angle, dose_col), where cols are the STAR_VALUE matches of the values
+    in line, so quoted values with spaces stay one column. cols is None for every line
+    that is not a data row of a loop containing both columns.
+    """
+    labels = None  # labels of the current loop, None outside of a loop
+    in_header = False
+    tilt_col = dose_col = None
+    for line in star_handle:
+        stripped = line.strip()
+        if stripped.startswith('data_'):
+            labels, in_header = None, False
+        elif stripped.startswith('loop_'):
+            labels, in_header = [], True
+        elif stripped.startswith('_'):
+            if in_header:
+                labels.append(stripped.split()[0])
+            else:
+                # a key-value pair after the rows ends the loop
+                labels = None
+        elif stripped and not stripped.startswith('#') and labels:
+            if in_header:
+                in_header = False
+                has_cols = TILT_ANGLE_LABEL in labels and PRE_EXPOSURE_LABEL in labels
+                tilt_col = labels.index(TILT_ANGLE_LABEL) if has_cols else None
+                dose_col = labels.index(PRE_EXPOSURE_LABEL) if has_cols else None
+            cols = list(STAR_VALUE.finditer(line))
+            if tilt_col is not None and len(cols) > max(tilt_col, dose_col):
+                try:
+                    yield line, cols, float(cols[tilt_col].group()), dose_col
+                    continue
+                except ValueError:
+                    pass
+        yield line, None, None, None
 
-    with open(star_file, 'r') as f:
-        lines = f.readlines()
+def adjust_pre_exposure(prior_doses, exposure_dose):
+    """
+    Round the mdoc prior doses to whole tilts and shift them by one tilt, so the first tilt has no pre-exposure.
+    """
+    mult = np.round(prior_doses / exposure_dose)
+    return np.maximum(mult * exposure_dose - exposure_dose, 0.0)
 
-    if len(lines) < 36:
-        print(f"File {star_file} is too short to contain data at line 36+")
-        return
+def write_star_chunk(out_handle, chunk, dose_index, exposure_dose, tolerance=None):
+    """
+    Write a chunk of read_star_tilt_rows output, with the pre-exposure of every data row
+    replaced by the one of its closest mdoc tilt. Only that value changes, the rest of the line is kept as it is.
+    Returns the number of updated rows and the tilt angles without a match within tolerance.
+    """
+    rows = [item for item in chunk if item[1] is not None]
+    tilt_angles = np.array([item[2] for item in rows], dtype=float)
+    prior_doses, matched = find_closest_doses(tilt_angles, dose_index, tolerance)
+    adjusted_doses = iter(adjust_pre_exposure(prior_doses, exposure_dose))
 
-    for i in range(35, len(lines)):
-        line = lines[i].strip()
-        if not line or line.startswith('#'):
+    for line, cols, _, dose_col in chunk:
+        if cols is None:
+            out_handle.write(line)
             continue
+        dose = cols[dose_col]
+        out_handle.write(line[:dose.start()] + f"{next(adjusted_doses):.4f}" + line[dose.end():])
+    return len(rows), tilt_angles[~matched]
 
-        cols = line.split()
-        if len(cols) < 5:
-            continue
+def matching_mdoc(star_file, mdoc_folder):
+    tomo_base = os.path.basename(star_file).replace('.mrc.star', '')
+    return os.path.join(mdoc_folder, f"{tomo_base}.mdoc")
 
-        try:
-            tilt_angle = float(cols[2])
-        except ValueError:
-            continue
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
-        prior_dose = find_closest_dose(tilt_angle, tilt_doses)
-        if prior_dose is None:
-            continue
+def load_manifest(star_folder):
+    """
+    Read the manifest of previous runs in star_folder.
+    Returns a dict of star file name -> manifest entry, empty if there is no (readable) manifest.
+    """
+    try:
+        with open(os.path.join(star_folder, MANIFEST_NAME), 'r') as f:
+            return json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def save_manifest(star_folder, manifest):
+    with tempfile.NamedTemporaryFile('w', dir=star_folder, suffix='.tmp', delete=False) as f:
+        json.dump({'version': 1, 'files': manifest}, f, indent=1, sort_keys=True)
+    os.chmod(f.name, file_mode(os.path.join(star_folder, MANIFEST_NAME)))
+    os.replace(f.name, os.path.join(star_folder, MANIFEST_NAME))
+
+def manifest_entry(star_file, mdoc_path, exposure_dose, input_sha256, output_sha256=None):
+    star_stat = os.stat(star_file)
+    mdoc_stat = os.stat(mdoc_path)
+    return {
+        'input_sha256': input_sha256,
+        'output_sha256': output_sha256 or file_sha256(star_file),
+        'size': star_stat.st_size,
+        'mtime_ns': star_stat.st_mtime_ns,
+        'mdoc': os.path.abspath(mdoc_path),
+        'mdoc_size': mdoc_stat.st_size,
+        'mdoc_mtime_ns': mdoc_stat.st_mtime_ns,
+        'exposure_dose': exposure_dose,
+    }
+
+def is_corrected(star_file, mdoc_path, entry, exposure_dose, check_hash=False):
+    """
+    Check whether a manifest entry shows that star_file was already corrected with this mdoc and exposure dose.
+    By default only the size and mtime of the files are compared. With check_hash a star file
+    that was touched since is still recognised when its content matches the corrected output.
+    """
+    if entry is None or entry['exposure_dose'] != exposure_dose or entry['mdoc'] != os.path.abspath(mdoc_path):
+        return False
+    try:
+        mdoc_stat = os.stat(mdoc_path)
+        star_stat = os.stat(star_file)
+    except FileNotFoundError:
+        return False
+    if (mdoc_stat.st_size, mdoc_stat.st_mtime_ns) != (entry['mdoc_size'], entry['mdoc_mtime_ns']):
+        return False
+    if (star_stat.st_size, star_stat.st_mtime_ns) == (entry['size'], entry['mtime_ns']):
+        return True
+    return check_hash and star_stat.st_size == entry['size'] and file_sha256(star_file) == entry['output_sha256']
 
-        mult = round(prior_dose / exposure_dose)
-        adjusted_dose = mult * exposure_dose - exposure_dose
-        if adjusted_dose < 0:
-            adjusted_dose = 0.0
+def update_star_file(star_file, mdoc_folder, exposure_dose, tolerance=None,
+                     cache_dir=None, cache_size=MDOC_CACHE_SIZE):
+    """
+    Update one STAR file using its corresponding MDOC file from a different folder.
+    The file is streamed into a temporary file next to it, which only replaces the
+    original once all rows have been rewritten.
+    If a tolerance (degrees) is given, the file is skipped when any of its tilts has
+    no mdoc tilt that close, as that usually means the wrong mdoc was picked up.
+    With a cache_dir the mdoc is read through the compiled mdoc cache.
+    Returns 'updated' or 'skipped'.
+    """
+    base_name = os.path.basename(star_file)
+    mdoc_path = matching_mdoc(star_file, mdoc_folder)
+
+    tilt_doses = parse_mdoc_tiltangle_prior_dose(mdoc_path, cache_dir, cache_size)
+    if not tilt_doses:
+        print(f"Skipping {star_file}: No valid data from {mdoc_path}")
+        return 'skipped'
+
+    print(f"Processing {star_file} using {mdoc_path}...")
 
-        cols[4] = f"{adjusted_dose:.4f}"
-        lines[i] = "\t".join(cols) + "\n"
+    dose_index = build_dose_index(tilt_doses)
+    n_rows = 0
+    unmatched = []
+    tmp_handle = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(star_file)),
+                                             prefix=f".{base_name}.", suffix='.tmp', delete=False)
+    try:
+        with open(star_file, 'r') as f, tmp_handle as out:
+            chunk = []
+            for item in read_star_tilt_rows(f):
+                chunk.append(item)
+                if len(chunk) >= CHUNK_SIZE:
+                    n, bad = write_star_chunk(out, chunk, dose_index, exposure_dose, tolerance)
+                    n_rows += n
+                    unmatched.extend(bad)
+                    chunk = []
+            n, bad = write_star_chunk(out, chunk, dose_index, exposure_dose, tolerance)
+            n_rows += n
+            unmatched.extend(bad)
+
+        if n_rows == 0:
+            print(f"Skipping {star_file}: no rows with {TILT_ANGLE_LABEL} and {PRE_EXPOSURE_LABEL} found")
+            return 'skipped'
+        if unmatched:
+            unmatched = ", ".join(f"{t:.2f}" for t in unmatched)
+            print(f"Skipping {star_file}: no tilt in {mdoc_path} within {tolerance} degrees of {unmatched}")
+            return 'skipped'
 
-    with open(star_file, 'w') as f:
-        f.writelines(lines)
+        shutil.copymode(star_file, tmp_handle.name)
+        os.replace(tmp_handle.name, star_file)
+    finally:
+        if os.path.exists(tmp_handle.name):
+            os.remove(tmp_handle.name)
 
     print(f"Updated file saved: {star_file}")
+    return 'updated'
 
-def update_all_star_files(star_folder, mdoc_folder, exposure_dose):
+def update_star_file_logged(star_file, mdoc_folder, exposure_dose, tolerance=None,
+                            cache_dir=None, cache_size=MDOC_CACHE_SIZE, entry=None):
+    """
+    Run update_star_file with its output captured, so the logs of parallel workers don't interleave.
+    If the manifest entry of the star file shows that its content is already corrected, it is left alone.
+    Returns a tuple: (star_file, status, log, entry) where status is 'updated', 'unchanged',
+    'skipped' or 'failed' and entry is the new manifest entry (None if the star file wasn't corrected).
+    """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            mdoc_path = matching_mdoc(star_file, mdoc_folder)
+            if is_corrected(star_file, mdoc_path, entry, exposure_dose, check_hash=True):
+                print(f"Skipping {star_file}: already corrected")
+                status = 'unchanged'
+                entry = manifest_entry(star_file, mdoc_path, exposure_dose,
+                                       entry['input_sha256'], entry['output_sha256'])
+            else:
+                input_sha256 = file_sha256(star_file)
+                status = update_star_file(star_file, mdoc_folder, exposure_dose, tolerance,
+                                          cache_dir, cache_size)
+                entry = manifest_entry(star_file, mdoc_path, exposure_dose, input_sha256) \
+                    if status == 'updated' else None
+        except Exception as e:
+            print(f"Failed to update {star_file}: {e}")
+            status, entry = 'failed', None
+    return star_file, status, log.getvalue(), entry
+
+def update_all_star_files(star_folder, mdoc_folder, exposure_dose, tolerance=None, jobs=1,
+                          cache_dir=None, cache_size=MDOC_CACHE_SIZE, force=False):
     """
     Process all star files in star_folder using matching mdoc files from mdoc_folder.
+    Star files that the manifest in star_folder lists as corrected with the same mdoc and
+    exposure dose are skipped, unless force is set.
+    With jobs > 1 the star files are spread over a pool of worker processes.
+    With a cache_dir the mdocs are read through the compiled mdoc cache in that folder.
+    Returns a dict with the updated, unchanged, skipped and failed star files.
     """
     pattern = os.path.join(star_folder, '*.mrc.star')
-    star_files = glob.glob(pattern)
+    star_files = sorted(glob.glob(pattern))
+    summary = {'updated': [], 'unchanged': [], 'skipped': [], 'failed': []}
 
     if not star_files:
         print("No matching star files found.")
-        return
+        return summary
 
+    old_manifest = {} if force else load_manifest(star_folder)
+    manifest = {}
+    todo = []
+    # Files with the same size and mtime as after their correction don't need to go to a worker
     for star_file in star_files:
-        update_star_file(star_file, mdoc_folder, exposure_dose)
+        name = os.path.basename(star_file)
+        entry = old_manifest.get(name)
+        if is_corrected(star_file, matching_mdoc(star_file, mdoc_folder), entry, exposure_dose):
+            summary['unchanged'].append(star_file)
+            manifest[name] = entry
+        else:
+            todo.append((star_file, entry))
+    if summary['unchanged']:
+        print(f"{len(summary['unchanged'])} star files are already corrected according to {MANIFEST_NAME}")
+
+    worker = partial(update_star_file_logged, mdoc_folder=mdoc_folder,
+                     exposure_dose=exposure_dose, tolerance=tolerance,
+                     cache_dir=cache_dir, cache_size=cache_size)
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            futures = [pool.submit(worker, star_file, entry=entry) for star_file, entry in todo]
+            results = (future.result() for future in futures)
+        else:
+            results = (worker(star_file, entry=entry) for star_file, entry in todo)
+        # Logs are printed per star file, in order, as soon as a file is done
+        for star_file, status, log, entry in results:
+            print(log, end='')
+            summary[status].append(star_file)
+            if entry is not None:
+                manifest[os.path.basename(star_file)] = entry
+
+    save_manifest(star_folder, manifest)
+
+    print(f"\nSummary: {len(summary['updated'])} updated, {len(summary['unchanged'])} already corrected, "
+          f"{len(summary['skipped'])} skipped, {len(summary['failed'])} failed")
+    for status in ('skipped', 'failed'):
+        for star_file in summary[status]:
+            print(f"  {status}: {star_file}")
+    return summary
 
 if __name__ == "__main__":
     import argparse
@@ -111,7 +437,19 @@ if __name__ == "__main__":
     parser.add_argument("star_folder", help="Folder containing .star files")
     parser.add_argument("mdoc_folder", help="Folder containing .mdoc files")
     parser.add_argument("exposure_dose", type=float, help="Exposure dose per tilt (e-/Å²)")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="Maximum difference (degrees) between a star file tilt and the closest mdoc tilt, files with tilts outside of this are skipped")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of star files to process in parallel")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder for the compiled mdoc cache (default: .mdoc_cache in the star folder)")
+    parser.add_argument("--cache-size", type=float, default=MDOC_CACHE_SIZE / 1024**2,
+                        help="Maximum size of the compiled mdoc cache in MB")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the mdoc files, don't use or update the cache")
+    parser.add_argument("--force", action="store_true",
+                        help=f"Correct all star files, also the ones {MANIFEST_NAME} lists as already corrected")
 
     args = parser.parse_args()
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.star_folder, '.mdoc_cache'))
 
-    update_all_star_files(args.star_folder, args.mdoc_folder, args.exposure_dose)
+    update_all_star_files(args.star_folder, args.mdoc_folder, args.exposure_dose, args.tolerance, args.jobs,
+                          cache_dir, int(args.cache_size * 1024**2), args.force)
@@ -0,0 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import warnings
+import numpy as np
+
+# Bootstrap of the histograms of get_hist.py. The points of one tomogram aren't independent, so the tomograms are
+# resampled (with replacement) and not the points. Works on the count matrices of the tomograms,
+# counts is an array (tomograms, doublets, classes)
+
+# Number of resamples drawn at once
+block_size = 1000
+
+def resample_counts(counts, n_resamples, seed=None):
+    # Summed count matrices of n_resamples resamples of the tomograms, (n_resamples, doublets, classes).
+    # Every row of weights is how often each tomogram is drawn in one resample, so all resamples are one product
+    rng = np.random.default_rng(seed)
+    n_tomograms = counts.shape[0]
+    weights = rng.multinomial(n_tomograms, np.full(n_tomograms, 1 / n_tomograms), size=n_resamples)
+    return (weights @ counts.reshape(n_tomograms, -1)).reshape(n_resamples, *counts.shape[1:])
+
+def histogram_values(counts, groups, normalized=True):
+    # The bars of the histograms for stacked count matrices (..., doublets, classes): the doublets are summed into
+    # groups with groups, a (groups, doublets) matrix of 0 and 1, and divided by the total of the group when normalized
+    values = np.einsum('gd,...dc->...gc', groups, counts.astype(float))
+    if normalized:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = values / values.sum(axis=-1, keepdims=True)
+    return values
+
+def _bootstrap_part(counts, statistic, n_resamples, seed):
+    return statistic(resample_counts(counts, n_resamples, seed))
+
+def bootstrap(counts, statistic, n_resamples=10000, jobs=1, seed=0):
+    """
+    statistic of n_resamples resamples of the tomograms, stacked in the first axis. statistic gets the summed
+    count matrices of the resamples (n, doublets, classes), e.g. partial(histogram_values, groups=...).
+    The resamples are drawn in blocks of block_size, every block with its own seed from seed, and with jobs > 1
+    the blocks are split over jobs processes. So the result only depends on seed, not on jobs
+    """
+    sizes = [block_size] * (n_resamples // block_size) + ([n_resamples % block_size] if n_resamples % block_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if jobs == 1:
+        return np.concatenate([_bootstrap_part(counts, statistic, size, block_seed)
+                               for size, block_seed in zip(sizes, seeds)])
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return np.concatenate(list(pool.map(partial(_bootstrap_part, counts, statistic), sizes, seeds)))
+
+def confidence_interval(counts, statistic, n_resamples=10000, confidence=0.95, jobs=1, seed=0):
+    # Lower and upper bound of the percentile bootstrap interval of statistic, NaN where it is undefined
+    # (a doublet group without points)
+    samples = bootstrap(counts, statistic, n_resamples, jobs, seed)
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN slices
+        lower, upper = np.nanquantile(samples, [alpha, 1 - alpha], axis=0)
+    return lower, upper
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# Which inputs every stage (format_inital, get_hist, ...) last ran with, per tomogram, kept in the results folder
+# The keys only cover the input files and settings, not the code. So every script has a stage_version in its keys:
+# increase it when a change to the code changes the results and the results of earlier runs are redone
+state_file = '.build_state.json'
+
+def file_digest(path):
+    # sha256 of the content of a file, None if it doesn't exist
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stage_key(files=(), **params):
+    # One hash of the content of the input files and the parameters (metadata entries, settings) of a stage
+    inputs = {'files': {str(path): file_digest(path) for path in files}, 'params': params}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def file_mode(path):
+    # Permissions for a temporary file that replaces path: those of the file it replaces, or 0666 minus the umask
+    # for a new file. tempfile makes 0600 files, which others in a shared project folder can't read
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def load_state(analysis_folder):
+    try:
+        with open(f"{analysis_folder}/{state_file}", 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+def save_state(analysis_folder, state):
+    # Write to a temporary file first so an interrupted run never leaves a broken state file
+    os.makedirs(analysis_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=analysis_folder, suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(state, file, indent=1, sort_keys=True)
+        os.chmod(tmp_path, file_mode(f"{analysis_folder}/{state_file}"))
+        os.replace(tmp_path, f"{analysis_folder}/{state_file}")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def is_current(state, stage, target, key, outputs=()):
+    # True when the stage already ran for this target (a tomogram or a combined result) with the same inputs
+    # and its outputs are still there
+    entry = state.get(stage, {}).get(target)
+    return entry is not None and entry['key'] == key and all(os.path.exists(path) for path in outputs)
+
+def mark_done(state, stage, target, key, **results):
+    # Remember the inputs of a finished stage, results are small values the next run can reuse
+    state.setdefault(stage, {})[target] = dict(key=key, **results)
@@ -1,47 +1,60 @@
 import numpy as np
-import pandas as pd
 import os 
 from scipy.stats import chi2_contingency
+from build_state import load_state, save_state, stage_key, is_current, mark_done
+from points_dataset import read_points, partition_path
 
 # TODO: this should be converted to argparse
 rawdata_folder = 'Data'
 analysis_folder = 'Results'
 results_folder = "Stats"
 
+# Redo all tomograms, also the ones whose points and settings didn't change since the last run
+force = False
+
+# Increase when a code change changes the statistics, see build_state.py
+stage_version = 1
+
 data = []
 
 # Ensure output folder exists
 if not os.path.exists(f"{analysis_folder}/{results_folder}"):
     os.makedirs(f"{analysis_folder}/{results_folder}")
 
-for foldername in os.listdir(rawdata_folder):
+# Only redo the statistics of tomograms whose points changed since the last run
+state = load_state(analysis_folder)
+
+for foldername in sorted(os.listdir(rawdata_folder)):
     # Skip poly01Tomo01 because it only has 1 class so there are no other classes to compare it with
     if foldername == 'poly01Tomo01':
         continue
 
     # Set formatted file names and associated paths
-    input_file = f'{foldername}_bin4_points.csv'
-    input_file_count = f'{foldername}_count.csv'
-    input_file_path = f"{analysis_folder}/{foldername}/{input_file}"
-    input_file_count_path = f"{analysis_folder}/{foldername}/{input_file_count}"
+    input_file_path = partition_path(analysis_folder, foldername)
 
     export_file = f"{foldername}_statistics.txt"
     export_file_path = f"{analysis_folder}/{results_folder}/{export_file}"
 
+    key = stage_key([input_file_path], version=stage_version)
+    if not force and is_current(state, 'calculate_stats', foldername, key, [export_file_path]):
+        print(f"The statistics for {foldername} are up to date")
+        continue
+
     if os.path.exists(export_file_path):
         os.remove(export_file_path)
 
+    # Ensure input file exists
+    if not os.path.exists(input_file_path):
+        print(f"Couldn't find {foldername}, moving on..")
+        continue
+
     print(f"Currently gettings statistics for {foldername}")
 
+    # Load the doublet and class of the points once, the count is the number of points per doublet
+    df = read_points(analysis_folder, ['Doublet', 'class'], [foldername])
+    df_count = df['Doublet'].value_counts().sort_index().rename_axis('Doublet').reset_index(name='Count')
+
     for dynein_class in [[1],[2,4],[3]]:
-        # Ensure input file exists
-        if not (os.path.exists(input_file_path) and os.path.exists(input_file_count_path)):
-            print(f"Couldn't find {foldername}, moving on..")
-            continue
-        
-        # Load the nessecary files as dataframes
-        df = pd.read_csv(input_file_path)
-        df_count = pd.read_csv(input_file_count_path)
 
         # Filter data for specific doublets and dynein classes
         doublet_1_4 = df[df['Doublet'].isin([1, 2, 3, 4])]
@@ -102,5 +115,7 @@ for foldername in os.listdir(rawdata_folder):
         with open(export_file_path, 'a') as file:
             file.write(results)
 
+    if os.path.exists(export_file_path):
+        mark_done(state, 'calculate_stats', foldername, key)
 
-
+save_state(analysis_folder, state)
@@ -1,7 +1,8 @@
 import numpy as np
 import os
-import pandas as pd
 import matplotlib.pyplot as plt
+from build_state import load_state, save_state, stage_key, is_current, mark_done
+from points_dataset import read_points, partition_path
 
 # Declaring important folders
 rawdata_folder = 'Data'
@@ -12,77 +13,96 @@ results_folder = "EORS"
 if not os.path.exists(f"{analysis_folder}/{results_folder}"):
     os.makedirs(f"{analysis_folder}/{results_folder}")
 
-# Declare the results overview file and remove it if it already exists
+# Declare the results overview file, it is rewritten at the end of every run
 overview_results = "overview_bending_results.txt"
 overview_results_path = f"{analysis_folder}/{results_folder}/{overview_results}"
 
-if os.path.exists(overview_results_path):
-    os.remove(overview_results_path)
-
 # Adjustable parameters, print_results prints intermediate results into the console and show_plots displays the relevant plots while the code is running. This is useful for debugging for explaining what the code is doing.
 print_results = False
 show_plots = False
 
-# Function to calculate the angles between direction vectors of segments
-def calculate_angles(data, num_segments, angle_threshold):
-    # Calculate the length of each segment
-    segment_length = len(data) // num_segments
-
-    # Initialize empty lists
-    direction_vectors = [] # Initialize a list to store the direction vectors of each segment
-    angles = [] # Initialize a list to store the angles between consecutive direction vectors
+# Adjustable parameters, after optimizing, these were the best settings
+angle_threshold = 6  # When the angle is greater than x degrees, it is considered a bend
+bend_threshold = 100 # Everything greater than x degrees, will be removed because junkdata
+num_segments = 10    # How many segments per doublet
+
+# Redo all tomograms, also the ones whose points and settings didn't change since the last run
+force = False
+
+# Increase when a code change changes the EORS scores, see build_state.py
+# 2: the segment directions all point along the doublet, which changes the angles and scores of version 1
+stage_version = 2
+
+# Function to calculate the direction vectors of the segments of many doublets at once
+def segment_directions(data_lists, num_segments):
+    """
+    Direction of every segment of every doublet in data_lists (a list of (n, 3) arrays, the doublets of
+    any number of tomograms), an array (doublets, num_segments, 3). Every doublet is cut into num_segments segments
+    of len(data) // num_segments points, left over points at the end are not used. The direction is the line
+    through the points of the segment, pointing from the first to the last point
+    """
+    # Segment number of every point of all doublets, -1 for the left over points
+    lengths = np.array([len(data) for data in data_lists])
+    segment_length = np.repeat(lengths // num_segments, lengths)
+    position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) # point number in its doublet
+    segment = np.where(segment_length > 0, position // np.maximum(segment_length, 1), num_segments)
+    used = segment < num_segments
+    segment_id = (np.repeat(np.arange(len(data_lists)), lengths) * num_segments + segment)[used]
+    points = np.concatenate([np.asarray(data, float).reshape(-1, 3) for data in data_lists])[used]
+    position = position[used]
+    n_segments = len(data_lists) * num_segments
+
+    # Mean-center every segment
+    counts = np.bincount(segment_id, minlength=n_segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.stack([np.bincount(segment_id, points[:, i], n_segments) for i in range(3)], axis=1) / counts[:, None]
+        centered = points - means[segment_id]
+
+        # Covariance matrix of every segment, (segments, 3, 3)
+        products = (centered[:, :, None] * centered[:, None, :]).reshape(-1, 9)
+        covariances = np.stack([np.bincount(segment_id, products[:, i], n_segments) for i in range(9)], axis=1)
+        covariances = covariances.reshape(-1, 3, 3) / counts[:, None, None]
+
+    # The eigenvector of the largest eigenvalue of the covariance is the first right singular vector of the
+    # mean-centered segment (what np.linalg.svd gives), eigh sorts the eigenvalues ascending.
+    # Segments without points get NaN
+    empty = counts == 0
+    directions = np.full((n_segments, 3), np.nan)
+    directions[~empty] = np.linalg.eigh(covariances[~empty])[1][:, :, -1]
+
+    # The sign of an eigenvector is arbitrary, point every direction along the doublet so consecutive segments
+    # give the bend and not 180 degrees minus the bend
+    projection = np.einsum('ij,ij->i', centered, directions[segment_id])
+    mean_position = np.bincount(segment_id, position, n_segments)[segment_id] / counts[segment_id]
+    orientation = np.bincount(segment_id, projection * (position - mean_position), n_segments)
+    directions[orientation < 0] *= -1
+    return directions.reshape(len(data_lists), num_segments, 3)
 
-    # Loop through the data to create direction vectors for each segment
-    for i in range(num_segments):
-        # Extract the segment from the data
-        segment = data[i * segment_length:(i + 1) * segment_length]
-        
-        # Calculate the mean of the segment
-        segment_mean = segment.mean(axis=0)
-
-        # Perform Singular Value Decomposition (SVD) on the mean-centered segment
-        uu, dd, vv = np.linalg.svd(segment - segment_mean)
-        
-        # The first right singular vector (vv[0]) represents the direction of the segment
-        direction_vectors.append(vv[0])
+# Function to calculate the angles between direction vectors of segments
+def calculate_angles(data_lists, num_segments, angle_threshold):
+    # Angles (in degrees) between consecutive segments of every doublet in data_lists,
+    # a list per doublet with the angles that are not greater than the angle_threshold
+    directions = segment_directions(data_lists, num_segments)
 
-    # Loop through the direction vectors to calculate angles between consecutive vectors    
-    for i in range(len(direction_vectors) - 1):
-        vec1 = direction_vectors[i]
-        vec2 = direction_vectors[i + 1]
-        
-        # Calculate the cosine of the angle between the two vectors   
-        # Using np.clip to prevent numerical issues by ensuring the cosine value is within [-1, 1]     
-        angle = np.arccos(np.clip(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)), -1.0, 1.0))
-        
-        # Calculate the angle in degrees
-        angle_degrees = np.degrees(angle)
+    # Calculate the cosine of the angles between all consecutive direction vectors at once
+    # Using np.clip to prevent numerical issues by ensuring the cosine value is within [-1, 1]
+    vec1, vec2 = directions[:, :-1], directions[:, 1:]
+    cosines = np.sum(vec1 * vec2, axis=-1) / (np.linalg.norm(vec1, axis=-1) * np.linalg.norm(vec2, axis=-1))
+    angles_degrees = np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
 
-        # Filter out angles that are greater than the angle_threshold
-        if angle_degrees <= angle_threshold: 
-            angles.append(angle_degrees)
-    
-    return angles
+    # Filter out angles that are greater than the angle_threshold
+    return [[angle for angle in angles if angle <= angle_threshold] for angles in angles_degrees.tolist()]
 
 # Function to process the angle data 
-def calculate_fit(data_lists, foldername):
-    # Adjustable parameters, after optimizing, these were the best settings
-    angle_threshold = 6  # When the angle is greater than x degrees, it is considered a bend
-    bend_threshold = 100 # Everything greater than x degrees, will be removed because junkdata
-    num_segments = 10    # How many segments per doublet
-
+def calculate_fit(all_angles, data_lists, foldername):
+    # all_angles are the angles of every doublet of the tomogram (see calculate_angles), data_lists the points
     # Initialize empty lists
-    all_angles = [] 
     bent_lists = [] 
     bending_amounts = []
     angle_differences = []
 
-    # Loop through each doublet of data points
-    for index, data in enumerate(data_lists, start=1):
-        # Calculate angles for the current doublet
-        angles = calculate_angles(data, num_segments, bend_threshold)
-        all_angles.append(angles)
-        
+    # Loop through the angles of each doublet
+    for index, angles in enumerate(all_angles, start=1):
         # Sum of absolute angles as bending metric
         bending_amount = np.sum(np.abs(angles))  
         bending_amounts.append(bending_amount)
@@ -137,14 +157,12 @@ def calculate_fit(data_lists, foldername):
 
     print(f"Results written to {single_result}\n")
 
-    # Write results to a single file which will contains a summary of the analysis
-    with open(overview_results_path, "a") as file:
-        file.write(f"Aggregate Scores for {foldername}:\n")
-        file.write(f"Mean Bending Amount: {mean_bending}\n")
-        file.write(f"Average angle difference: {angle_differences_average}\n")
-        file.write(f"Maximum Bending Amount: {max_bending}\n")
-        
-        file.write(f"{result}\n\n")
+    # The summary for the overview file which contains all tomograms
+    overview = (f"Aggregate Scores for {foldername}:\n"
+                f"Mean Bending Amount: {mean_bending}\n"
+                f"Average angle difference: {angle_differences_average}\n"
+                f"Maximum Bending Amount: {max_bending}\n"
+                f"{result}\n\n")
 
     # Visualize the bending amounts in a bar graph
     if show_plots:
@@ -169,31 +187,50 @@ def calculate_fit(data_lists, foldername):
 
         plt.show()
 
-# Main loop
-for foldername in os.listdir(rawdata_folder):
-    points_list = []
+    return overview
+
+# Only recalculate the tomograms whose points or settings changed since the last run, plots need a rerun
+state = load_state(analysis_folder)
+overviews = {}
+todo = {}
 
-    input_file = f'{foldername}_bin4_points.csv'
-    input_file_path = f"{analysis_folder}/{foldername}/{input_file}"
+# Main loop
+for foldername in sorted(os.listdir(rawdata_folder)):
+    input_file_path = partition_path(analysis_folder, foldername)
+    single_result_path = f"{analysis_folder}/{results_folder}/{foldername}_bending_results.txt"
 
     # Ensure input file exists
     if not os.path.exists(input_file_path):
         print(f"Couldn't find {foldername}, moving on..\n")
         continue
+
+    key = stage_key([input_file_path], angle_threshold=angle_threshold, bend_threshold=bend_threshold, num_segments=num_segments,
+                    version=stage_version)
+    if not force and not show_plots and is_current(state, 'englishORspanish', foldername, key, [single_result_path]):
+        print(f"The EORS score for {foldername} is up to date\n")
+        overviews[foldername] = state['englishORspanish'][foldername]['overview']
+        continue
     
-    print(f"Currently calculating the EORS score for {foldername}")
+    print(f"Currently reading the points of {foldername}")
+
+    df = read_points(analysis_folder, ['Doublet', 'X', 'Y', 'Z'], [foldername])
 
-    df = pd.read_csv(input_file_path)
+    # The X, Y and Z coordinates of the points of each doublet
+    points_list = [df.loc[df['Doublet'] == doublet, ['X', 'Y', 'Z']].to_numpy() for doublet in range(1, 10)]
+    todo[foldername] = (key, points_list)
 
-    # Looping through each doublet 
-    for doublet in range(1,10):
-        # Filter the data based on in which doublet they are 
-        filtered_df = df.query(f'Doublet == {doublet}')
+# The angles of all segments of all doublets of all tomograms are calculated at once
+all_angles = calculate_angles([data for key, points_list in todo.values() for data in points_list], num_segments,
+                              bend_threshold) if todo else []
 
-        # Extract the X, Y and Z coordinates of each point
-        points_xyz = filtered_df[['X', 'Y', 'Z']].values.tolist()
+for index, (foldername, (key, points_list)) in enumerate(todo.items()):
+    print(f"Currently calculating the EORS score for {foldername}")
+    overview = calculate_fit(all_angles[9*index:9*(index + 1)], points_list, foldername)
+    mark_done(state, 'englishORspanish', foldername, key, overview=overview)
+    overviews[foldername] = overview
 
-        points_xyz = np.array(points_xyz)
-        points_list.append(points_xyz)
+# Write results to a single file which will contains a summary of the analysis
+with open(overview_results_path, "w") as file:
+    file.writelines(overviews[foldername] for foldername in sorted(overviews))
 
-    calculate_fit(points_list, foldername)
\ No newline at end of file
+save_state(analysis_folder, state)
@@ -1,18 +1,28 @@
-import csv
+import argparse
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import yaml
+from imod_model import read_model_points
+from build_state import load_state, save_state, stage_key, is_current, mark_done
+from points_dataset import write_partition, partition_path, read_points
+from rendering import figure_formats, figure_file, draw_class_table, render_all
 
 rawdata_folder = 'Data'
 analysis_folder = 'Results'
 metadata_file = 'metadata.yaml'
 
-# Ensure output folder exists
-if not os.path.exists(metadata_file):
-    os.makedirs(analysis_folder)
+# Increase when a code change changes the points or tables, see build_state.py
+stage_version = 1
+
+# Define a color map for the classes => PEET 
+class_colors = {
+    1: '#0173b2',
+    2: '#de8f05',
+    3: '#029e73',
+    4: '#de8f05'
+}
 
 def transform_value_c(x):
     return ((x - 1) % 9) + 1
@@ -20,72 +30,34 @@ def transform_value_c(x):
 def transform_value_cc(x):    
     return ( - ( x - 1 ) % 9) + 1
 
-def calculate_counts(data):
-    df = pd.read_csv(data)
-    max_rows = df['Doublet'].value_counts()
-    sorted_max_rows = max_rows.sort_index()
-
-    counts_file = f"{foldername}_count.csv"
-    counts_file_path = f"{analysis_folder}/{foldername}/{counts_file}"
-
-    sorted_max_rows.reset_index().to_csv(counts_file_path, header=['Doublet', 'Count'], index=False)
-    print(f"Succesfully counted the instances of each class for {foldername}")
-
-def show_plot(data):
-    df = pd.read_csv(data)
-
-    # Find the maximum number of rows needed for any Doublet
-    max_rows = df['Doublet'].value_counts().max()
-
-    # Initialize the table with NaN values
-    table_data = np.full((max_rows, 9), np.nan)
-    class_data = np.full((max_rows, 9), np.nan)
-
-    # Populate the table with the class values
-    for i, doublet in enumerate(sorted(df['Doublet'].unique())):
-        doublet_data = df[df['Doublet'] == doublet]['class'].values
-        table_data[:len(doublet_data), i] = doublet_data
-        class_data[:len(doublet_data), i] = doublet_data
-
-    # Define a color map for the classes => PEET 
-    class_colors = {
-        1: '#0173b2',
-        2: '#de8f05',
-        3: '#029e73',
-        4: '#de8f05'
-    }
-
-    # Create a colormap for class values
-    colors = np.vectorize(class_colors.get)(class_data)
-
-    fig, ax = plt.subplots()
-
-    # Hide axes
-    ax.xaxis.set_visible(False) 
-    ax.yaxis.set_visible(False)
-    ax.set_frame_on(False)
-
-    # Create the table
-    table = ax.table(cellColours=colors, #cellText=table_data
-                    colLabels=[f'Doublet {i+1}' for i in range(9)],
-                    cellLoc='center',
-                    loc='center',
-                    colWidths=[0.07 for i in range(9)])
-
-    # Adjust the font size
-    table.auto_set_font_size(True)
-
-    # Scale the table
-    table.scale(0.6, 0.35)
-
-    # Figure creation 
-    fig_name = f"{foldername}_figure.png"
-    fig_path = f"{analysis_folder}/{foldername}/{fig_name}"
-    plt.savefig(fig_path, dpi = 600)
-
-    print(f"Succesfully made a figure of {foldername}")
-
-def prepare_metadata():
+def class_matrix(df):
+    # Table with the classes of every doublet in a column (the doublets in sorted order) padded with NaN,
+    # the row of a point is its number within its doublet
+    columns, column_index = np.unique(df['Doublet'].to_numpy(), return_inverse=True)
+    rows = df.groupby('Doublet', sort=False).cumcount().to_numpy()
+    class_data = np.full((rows.max() + 1, 9), np.nan)
+    class_data[rows, column_index] = df['class'].to_numpy()
+    return class_data
+
+def class_color_matrix(class_data):
+    # Look up table from class to color, empty cells and unknown classes get no color ('None')
+    lut = np.full(max(class_colors) + 2, 'None', dtype=object)
+    for class_nr, color in class_colors.items():
+        lut[class_nr] = color
+    index = np.nan_to_num(class_data, nan=-1)
+    known = (index >= 0) & (index <= max(class_colors)) & (index == np.floor(index))
+    return lut[np.where(known, index, -1).astype(int)] # -1 is the last entry of the table, 'None'
+
+def table_figure(foldername, analysis_folder=analysis_folder):
+    # Render task (see rendering.render_all) for the class table of a tomogram, from its points in the dataset
+    df = read_points(analysis_folder, ['Doublet', 'class'], [foldername])
+
+    # Table with the class values and their colors
+    colors = class_color_matrix(class_matrix(df))
+    data = {'colors': colors, 'column_labels': [f'Doublet {i+1}' for i in range(9)]}
+    return draw_class_table, data, f"{analysis_folder}/{foldername}/{foldername}_figure", (6.4, 4.8)
+
+def prepare_metadata(rawdata_folder=rawdata_folder, metadata_file=metadata_file):
 
     metadata = {
             "ready4analysis": False,
@@ -122,7 +94,7 @@ def prepare_metadata():
     except IOError as e:
         print(f"Error writing to '{metadata_file}': {e}")
 
-def read_metadata():
+def read_metadata(metadata_file=metadata_file):
     try:
         with open(metadata_file, 'r') as file:
             metadata = yaml.safe_load(file)
@@ -131,99 +103,160 @@ def read_metadata():
         print(f"Error reading '{metadata_file}': {e}")
         return None
 
-# Ensure metadata file exists
-if not os.path.exists(metadata_file):
-    prepare_metadata()
-
-# Read the metadata file in memory
-yaml_file = read_metadata()
-
-# If Ready for analysis is false, return error
-if yaml_file is None or not yaml_file['ready4analysis']:
-    print('Please check the metadata file and make sure everything in entered!')
-    exit()
-
-# Main loop
-for foldername in os.listdir(rawdata_folder):
-    input_file = f'{foldername}_bin4_doublets_PtsAdded.mod'
-    input_file_path = f"{rawdata_folder}/{foldername}/{input_file}"
-    
-    output_file = f"{foldername}_bin4_points.txt"
-    output_file_path = f"{analysis_folder}/{foldername}/{output_file}"
-
-    class_file = f"04_bin4_classification_MOTL_{foldername}_Iter2.csv"
-    class_file_path = f"{rawdata_folder}/{foldername}/{class_file}"
-
-    output_csv_file = f"{foldername}_bin4_points.csv"
-    output_csv_file_path = f"{analysis_folder}/{foldername}/{output_csv_file}"
+def read_mod_points(input_file_path):
+    # Read the contour and XYZ of every point straight from the .mod file
+    objects, contours, points = read_model_points(input_file_path)
+    points = points.astype(np.float64) # the analysis is done in double precision
+    return pd.DataFrame({'Point': np.arange(1, len(contours) + 1),
+                         'Contour': contours,
+                         'X': points[:, 0],
+                         'Y': points[:, 1],
+                         'Z': points[:, 2]})
+
+def correct_doublets(contours, first_doublet, clock_direction):
+    # Determine the correct doublet
+    shift = 1 - first_doublet # Calculate the relative shift based on first doublet
+    doublets = contours + shift # Apply shift on every data point
+    # The transforms only use modular arithmetic, so they work on the whole column at once
+    if clock_direction == 'c':
+        return transform_value_c(doublets) # Correct negative values
+    else:
+        return transform_value_cc(doublets)
+
+def tomogram_files(foldername, rawdata_folder=rawdata_folder, analysis_folder=analysis_folder):
+    # Input and output files of one tomogram
+    return {'mod': f"{rawdata_folder}/{foldername}/{foldername}_bin4_doublets_PtsAdded.mod",
+            'motl': f"{rawdata_folder}/{foldername}/04_bin4_classification_MOTL_{foldername}_Iter2.csv",
+            'points': partition_path(analysis_folder, foldername)}
+
+def process_tomogram(foldername, first_doublet, clock_direction, bend_direction='undetermined',
+                     rawdata_folder=rawdata_folder, analysis_folder=analysis_folder):
+    """
+    Points extraction, doublet correction and MOTL class join for one tomogram.
+    Only reads the files in rawdata_folder/foldername and writes the tomogram's partition of the points dataset.
+    Returns the path of the points partition, or None when an input file is missing
+    """
+    files = tomogram_files(foldername, rawdata_folder, analysis_folder)
+    input_file_path = files['mod']
+    input_file = os.path.basename(input_file_path)
+    class_file_path = files['motl']
+    class_file = os.path.basename(class_file_path)
 
     # Ensure output folder exists
-    if not os.path.exists(f"{analysis_folder}/{foldername}"):
-        os.makedirs(f"{analysis_folder}/{foldername}")
+    os.makedirs(f"{analysis_folder}/{foldername}", exist_ok=True)
     
     # Check if required files are there
     if not os.path.exists(input_file_path):
         print(f"{input_file} does not exists, moving on..")
-        continue
+        return None
 
     if not os.path.exists(class_file_path):
         print(f"{class_file} does not exists, moving on..")
-        continue
-
-    print(f"Currently getting the points file for {foldername}")
-
-    # Make a points file
-    if not os.path.exists(output_file_path):
-        os.system(f"model2point -contour {input_file_path} {output_file_path}")
-
-    print(f"Currently formatting the points file to csv for {foldername}")
-
-    # Read the data from the input file
-    data = []
-    with open(output_file_path, 'r') as file:
-        counter = 1  # Initialize counter
-        for line in file:
-            columns = line.split() # Split the line into columns based on whitespace
-            columns.insert(0, counter) # Insert the counter value at the beginning of the columns list
-            data.append(columns)
-            counter += 1  # Increment counter
-
-    # Write the data to the CSV file
-    with open(output_csv_file_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-
-        # Write the header
-        writer.writerow(['Point', 'Contour', 'X', 'Y', 'Z'])
-
-        # Write the data
-        for row in data:
-            writer.writerow(row)
-
-    print(f"Data successfully formatted into .csv")
+        return None
 
-    # Load the CSV file
-    df = pd.read_csv(output_csv_file_path)
-
-    # Determine the correct doublet
-    if yaml_file['clockDirection'][foldername] == 'c':
-        shift = 1 - yaml_file['firstDoublet'][foldername] # Calculate the relative shift based on first doublet
-        df['Doublet'] = df['Contour'] + shift # Apply shift on every data point
-        df['Doublet'] = df['Doublet'].apply(transform_value_c) # Correct negative values
-    else:
-        shift = 1 - yaml_file['firstDoublet'][foldername] 
-        df['Doublet'] = df['Contour'] + shift
-        df['Doublet'] = df['Doublet'].apply(lambda x: transform_value_cc(x))
+    print(f"Currently reading the points of {foldername}")
+    df = read_mod_points(input_file_path)
+    df['Doublet'] = correct_doublets(df['Contour'], first_doublet, clock_direction)
 
     # Load MOTL file
     df_class = pd.read_csv(class_file_path)
 
-    # Parse the right class from MOTL to new csv file
+    # Parse the right class from MOTL to the points
     df['class'] = df_class['class']
 
-    # Save the modified CSV file
-    df.to_csv(output_csv_file_path, index=False)
+    # Keep the metadata with the points so the other scripts only need the dataset
+    df['firstDoublet'] = first_doublet
+    df['clockDirection'] = clock_direction
+    df['bendDirection'] = bend_direction
+
+    # Save the points in the dataset
+    return write_partition(df, analysis_folder, foldername)
 
-    show_plot(output_csv_file_path)
-    calculate_counts(output_csv_file_path)
-    print()
-    print()
\ No newline at end of file
+def main(rawdata_folder=rawdata_folder, analysis_folder=analysis_folder, metadata_file=metadata_file, jobs=1, tomos=None,
+         force=False, figure_format='png'):
+    # Ensure output folder exists
+    os.makedirs(analysis_folder, exist_ok=True)
+
+    # Ensure metadata file exists
+    if not os.path.exists(metadata_file):
+        prepare_metadata(rawdata_folder, metadata_file)
+
+    # Read the metadata file in memory
+    yaml_file = read_metadata(metadata_file)
+
+    # If Ready for analysis is false, return error
+    if yaml_file is None or not yaml_file['ready4analysis']:
+        print('Please check the metadata file and make sure everything in entered!')
+        return 1
+
+    foldernames = [name for name in sorted(os.listdir(rawdata_folder)) if tomos is None or name in tomos]
+    # Only rerun tomograms whose .mod, MOTL or metadata entries changed since the last run
+    state = load_state(analysis_folder)
+    failed, n_current = [], 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for foldername in foldernames:
+            try:
+                first_doublet = yaml_file['firstDoublet'][foldername]
+                clock_direction = yaml_file['clockDirection'][foldername]
+            except (KeyError, TypeError):
+                print(f"{foldername} is missing from {metadata_file}, moving on..")
+                continue
+            bend_direction = (yaml_file.get('bendDirection') or {}).get(foldername, 'undetermined')
+            files = tomogram_files(foldername, rawdata_folder, analysis_folder)
+            key = stage_key([files['mod'], files['motl']], first_doublet=first_doublet, clock_direction=clock_direction,
+                            bend_direction=bend_direction, version=stage_version)
+            if not force and is_current(state, 'format_inital', foldername, key, [files['points']]):
+                n_current += 1
+                continue
+            futures[foldername] = (key, pool.submit(process_tomogram, foldername, first_doublet, clock_direction,
+                                                    bend_direction, rawdata_folder, analysis_folder))
+        for foldername, (key, future) in futures.items():
+            try:
+                if future.result() is not None:
+                    mark_done(state, 'format_inital', foldername, key)
+            except Exception as e:
+                print(f"{foldername} failed: {e}")
+                failed.append(foldername)
+    print(f"Processed {len(futures) - len(failed)} of {len(foldernames)} tomograms, {n_current} were up to date")
+
+    # Render the tables whose points or figure format changed, all at once on a process pool
+    foldernames = [name for name in foldernames if os.path.exists(partition_path(analysis_folder, name))]
+    multipage_file = f"{analysis_folder}/tables.pdf"
+    figure_keys = {}
+    if figure_format == 'multipage':
+        key = stage_key([partition_path(analysis_folder, name) for name in foldernames], version=stage_version)
+        if force or not is_current(state, 'format_inital_figure', 'multipage', key, [multipage_file]):
+            figure_keys['multipage'] = (key, foldernames)
+    else:
+        for foldername in foldernames:
+            key = stage_key([partition_path(analysis_folder, foldername)], figure_format=figure_format,
+                            version=stage_version)
+            figure_path = figure_file(f"{analysis_folder}/{foldername}/{foldername}_figure", figure_format)
+            if force or not is_current(state, 'format_inital_figure', foldername, key, [figure_path]):
+                figure_keys[foldername] = (key, [foldername])
+    tasks = [table_figure(name, analysis_folder) for key, names in figure_keys.values() for name in names]
+    try:
+        render_all(tasks, figure_format, jobs, multipage_file)
+        for target, (key, names) in figure_keys.items():
+            mark_done(state, 'format_inital_figure', target, key)
+        print(f"Made {len(tasks)} table figures" + (f" in {multipage_file}" if figure_format == 'multipage' else ''))
+    except Exception as e:
+        print(f"Making the table figures failed: {e}")
+        failed.append('figures')
+    save_state(analysis_folder, state)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make the points dataset and table figure of every tomogram in the data folder")
+    parser.add_argument('--data', default=rawdata_folder, help=f"Folder with a folder per tomogram (default: {rawdata_folder})")
+    parser.add_argument('--results', default=analysis_folder, help=f"Output folder (default: {analysis_folder})")
+    parser.add_argument('--metadata', default=metadata_file, help=f"Metadata file (default: {metadata_file})")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of tomograms to process in parallel")
+    parser.add_argument('--tomo', nargs='+', default=None, help="Only process these tomograms")
+    parser.add_argument('--force', action='store_true', help="Also process the tomograms whose inputs didn't change")
+    parser.add_argument('--figures', choices=list(figure_formats), default='png',
+                        help="preview: 100 dpi png, png: 600 dpi png (default), pdf/svg: vector figures, "
+                             "multipage: all tables in one pdf (Results/tables.pdf)")
+    args = parser.parse_args()
+    exit(main(args.data, args.results, args.metadata, args.jobs, args.tomo, args.force, args.figures))
@@ -1,15 +1,17 @@
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
+from functools import partial
 import numpy as np
+import pandas as pd
 import seaborn as sns
 import yaml
+from build_state import load_state, save_state, stage_key, is_current, mark_done
+from points_dataset import read_points, partition_path
+from rendering import figure_formats, figure_file, draw_histogram, render_all
+from bootstrap import confidence_interval, histogram_values
 
 rawdata_folder = 'Data'
 analysis_folder = 'Results'
 metadata_file = 'metadata.yaml'
-all_data_straight = pd.DataFrame()
-all_data_bend = pd.DataFrame()
 
 # If grouped is True, the individual histograms will be grouped using 1-4, 5, and 6-9 grouping
 grouped = True # True or False
@@ -19,10 +21,24 @@ grouped_formatted = 'grouped' if grouped else 'single'
 normalized = True # True or False
 normalized_formatted = 'normalized' if normalized else ''
 
-# Ensure metadata file exists
-if not os.path.exists(metadata_file):
-    print(f"Please run format_initial.py first before making histograms!")
-    exit()
+# Output of the figures: 'preview' (100 dpi png), 'png' (600 dpi png), 'pdf' or 'svg' (vector figures)
+# or 'multipage' (all histograms in Results/histograms.pdf)
+figure_format = 'png'
+multipage = figure_format == 'multipage'
+
+# Redo all tomograms, also the ones whose points and settings didn't change since the last run
+force = False
+
+# Increase when a code change changes the histograms, see build_state.py
+stage_version = 1
+
+# Number of figures rendered (and bootstrap parts calculated) in parallel
+jobs = 1
+
+# The combined histograms get error bars: a bootstrap confidence interval from n_resamples resamples of the
+# tomograms (0 for no error bars)
+n_resamples = 10000
+confidence = 0.95
 
 def read_metadata():
     try:
@@ -33,19 +49,47 @@ def read_metadata():
         print(f"Error reading '{metadata_file}': {e}")
         return None
 
-def generate_figure(input_file_path, output_file_path):
-    df = pd.read_csv(input_file_path)
-
-    # Group classes 2 and 4 together
-    df['class'] = df['class'].replace({2: 2, 4: 2})
+# The classes in the histograms, class 4 is counted as class 2
+class_numbers = [1, 2, 3]
+class_groups = {2: 2, 4: 2}
+
+# Doublets 1-4 are grouped into one group and 6-9 into another
+doublet_groups = {1: '1-4', 2: '1-4', 3: '1-4', 4: '1-4',5: '5', 6: '6-9', 7: '6-9', 8: '6-9', 9: '6-9'}
+
+def count_matrix(df):
+    # Number of points per doublet (rows, doublet 1-9) and class (columns, class_numbers) of one tomogram.
+    # The histograms only need these counts, so they are summed per bend direction instead of the points
+    class_nrs = df['class'].replace(class_groups).to_numpy()
+    column = np.searchsorted(class_numbers, class_nrs)
+    known = np.isin(class_nrs, class_numbers) & df['Doublet'].between(1, 9).to_numpy()
+    index = (df['Doublet'].to_numpy()[known] - 1) * len(class_numbers) + column[known]
+    return np.bincount(index.astype(int), minlength=9*len(class_numbers)).reshape(9, len(class_numbers))
+
+def doublet_index(grouped):
+    # Doublets (groups) of the histograms and which doublets are in every group, a (groups, doublets) 0/1 matrix
+    labels = ['1-4', '5', '6-9'] if grouped == True else list(range(1, 10))
+    keys = [doublet_groups[doublet] if grouped == True else doublet for doublet in range(1, 10)]
+    return labels, np.array([[float(key == label) for key in keys] for label in labels])
+
+def error_tables(tomogram_counts, grouped, pivot_df):
+    # Lower and upper bounds of the bootstrap confidence intervals of the bars in pivot_df,
+    # tomogram_counts are the count matrices of the tomograms in the histogram (tomograms, doublets, classes)
+    labels, groups = doublet_index(grouped)
+    lower, upper = confidence_interval(tomogram_counts, partial(histogram_values, groups=groups, normalized=normalized),
+                                       n_resamples, confidence, jobs)
+    return tuple(pd.DataFrame(bound, index=labels, columns=class_numbers).loc[pivot_df.index, pivot_df.columns]
+                 for bound in (lower, upper))
+
+def histogram_table(counts, grouped):
+    # Pivot the counts to have Doublet as rows and Class as columns, only the doublets and classes with points
+    pivot_df = pd.DataFrame(counts, index=pd.RangeIndex(1, 10, name='Doublet'),
+                            columns=pd.Index(class_numbers, name='class'))
+    pivot_df = pivot_df.loc[:, pivot_df.sum(axis=0) > 0]
 
     # Group doublets 1-4 into one group and 6-9 into another
     if grouped == True:
-        df['Doublet'] = df['Doublet'].replace({1: '1-4', 2: '1-4', 3: '1-4', 4: '1-4',5: '5', 6: '6-9', 7: '6-9', 8: '6-9', 9: '6-9'})
-
-    # Prepare data for histogram
-    # Pivot the data to have Doublet as columns and Class as subcolumns
-    pivot_df = df.pivot_table(index='Doublet', columns='class', values='Z', aggfunc='count', fill_value=0)
+        pivot_df = pivot_df.groupby(doublet_groups).sum()
+    pivot_df = pivot_df[pivot_df.sum(axis=1) > 0]
 
     # Normalize the counts by the total number of particles in each doublet group
     # axis=1 is one doublet, so sum(axis=1) sums all the classes so the total, then div() divides the indivudual count (axis=0) with the total
@@ -55,138 +99,145 @@ def generate_figure(input_file_path, output_file_path):
     # Ensure the order of doublets is 1-4, 5, 6-9
     if grouped == True:
         pivot_df = pivot_df.reindex(['1-4', '5', '6-9'])
+    return pivot_df
+
+def generate_figure(counts, output_file_path):
+    # Prepare data for histogram from the count matrix of the tomogram
+    pivot_df = histogram_table(counts, grouped)
 
     # Custom legend names
     custom_labels = {1: 'Unknown', 2: 'Pre PS', 3: 'Post PS'}
 
-    # Plotting
-    fig, ax = plt.subplots(figsize=(12, 8))
-
-    # Define bar width and positions
-    bar_width = 0.2
-    indices = np.arange(pivot_df.shape[0])
-
     # Use a colorblind-friendly palette
     colors = sns.color_palette("colorblind", n_colors=len(pivot_df.columns))
 
-    # Plot each class as subcolumns
-    for i, (class_label, color) in enumerate(zip(pivot_df.columns, colors)):
-        ax.bar(indices + i * bar_width, pivot_df[class_label], bar_width, label=custom_labels[class_label], color=color)
-
-    # Customizing the plot
-    ax.set_xlabel('Doublets')
-    ax.set_ylabel(f'{normalized_formatted.capitalize()} Count')
-    ax.set_title(f'{normalized_formatted.capitalize()} Histogram of Doublets with Classes')
-    ax.set_xticks(indices + bar_width)
-    ax.set_xticklabels(pivot_df.index)
-    ax.legend()
-
-    # Remove old plots because matplotlib doesn't overwrite old files
-    if os.path.isfile(output_file_path):
-        os.remove(output_file_path)
-
-    # Save the plot
-    plt.savefig(output_file_path, dpi = 600)
+    # Render task (see rendering.render_all), output_file_path without extension
+    data = {'pivot_df': pivot_df, 'colors': colors, 'labels': custom_labels, 'xlabel': 'Doublets',
+            'ylabel': f'{normalized_formatted.capitalize()} Count',
+            'title': f'{normalized_formatted.capitalize()} Histogram of Doublets with Classes'}
+    return draw_histogram, data, output_file_path, (12, 8)
 
-def generate_combined_histogram(input_file_path, grouped_combined, type):
-    # For comments check generate_figure()
+def generate_combined_histogram(tomogram_counts, grouped_combined, type):
+    # For comments check generate_figure(), tomogram_counts are the count matrices of the tomograms
     grouped_combined_formatted = 'grouped' if grouped_combined else 'single'
 
-    output_file = f"Combined_histogram_{grouped_combined_formatted}_{type}.png"
-    output_file_path = f"{analysis_folder}/{output_file}"
-
-    df = pd.read_csv(input_file_path)
+    output_file_path = f"{analysis_folder}/Combined_histogram_{grouped_combined_formatted}_{type}"
 
     print(f"Creating the combined histogram for the {type} tomograms in {grouped_combined_formatted} mode")
-    
-    df['class'] = df['class'].replace({2: 2, 4: 2})
-
-    if grouped_combined == True:
-        df['Doublet'] = df['Doublet'].replace({1: '1-4', 2: '1-4', 3: '1-4', 4: '1-4',5: '5', 6: '6-9', 7: '6-9', 8: '6-9', 9: '6-9'})
-    
-    pivot_df = df.pivot_table(index='Doublet', columns='class', values='Z', aggfunc='count', fill_value=0)
-    
-    if normalized == True:
-        pivot_df = pivot_df.div(pivot_df.sum(axis=1), axis=0)
 
-    if grouped_combined == True:
-        pivot_df = pivot_df.reindex(['1-4', '5', '6-9'])
+    pivot_df = histogram_table(tomogram_counts.sum(axis=0), grouped_combined)
 
-    # Plotting
-    fig, ax = plt.subplots(figsize=(12, 8))
+    # Error bars that resample the tomograms
+    errors = error_tables(tomogram_counts, grouped_combined, pivot_df) if n_resamples > 0 else None
 
-    bar_width = 0.2
-    indices = np.arange(pivot_df.shape[0])
     colors = sns.color_palette("colorblind", n_colors=len(pivot_df.columns))
     custom_labels = {1: 'Unknown', 2: 'Pre PS', 3: 'Post PS'}
 
-    for i, (class_label, color) in enumerate(zip(pivot_df.columns, colors)):
-        ax.bar(indices + i * bar_width, pivot_df[class_label], bar_width, label=custom_labels[class_label], color=color)
-
-    ax.set_xlabel('Doublets')
-    ax.set_ylabel(f'{normalized_formatted.capitalize()} Count')
-    ax.set_title(f'{normalized_formatted.capitalize()} Histogram of {grouped_combined_formatted} Doublets for all the {type} pieces')
-    ax.set_xticks(indices + bar_width)
-    ax.set_xticklabels(pivot_df.index)
-    ax.legend()
-
-    if os.path.isfile(output_file_path):
-        os.remove(output_file_path)
-
-    plt.savefig(output_file_path, dpi = 600)
-
-# Read the metadata file in memory
-yaml_file = read_metadata()
-
-# If Ready for analysis is false, return error
-if yaml_file is None or not yaml_file['ready4analysis']:
-    print('Please check the metadata file and make sure everything in entered!')
-    exit()
-
-# Main loop
-for foldername in os.listdir(rawdata_folder):
-    input_file = f'{foldername}_bin4_points.csv'
-    input_file_path = f"{analysis_folder}/{foldername}/{input_file}"
-    
-    output_file = f"{foldername}_bin4_points_histogram.png"
-    output_file_path = f"{analysis_folder}/{foldername}/{output_file}"
-
-    # Ensure input file exists
-    if not os.path.exists(input_file_path):
-        print(f"Couldn't find {foldername}, moving on..")
-        continue
-    
-    print(f"Currently making the histogram for {foldername}")
-
-    # Make a histogram
-    generate_figure(input_file_path, output_file_path)
-
-    # Group all data with same bend direction
-    if yaml_file['bendDirection'][foldername] == 'straight':
-        df = pd.read_csv(input_file_path)
-        all_data_straight = pd.concat([all_data_straight, df])
-    elif yaml_file['bendDirection'][foldername] == 'bend':
-        df = pd.read_csv(input_file_path)
-        all_data_bend = pd.concat([all_data_bend, df])
-    else:
-        print(f'{foldername} is undetermined, moving on..')
-        continue
-
-straight_csv_name = "all_data_straight.csv"
-straight_csv_path = f"{analysis_folder}/{straight_csv_name}"    
-
-bend_csv_name = "all_data_bend.csv"
-bend_csv_path = f"{analysis_folder}/{bend_csv_name}"
-
-if not all_data_straight.empty:
-    all_data_straight.to_csv(straight_csv_path, index=False)
-
-if not all_data_bend.empty:
-    all_data_bend.to_csv(bend_csv_path, index=False)
-
-# Generate combined histograms
-generate_combined_histogram(straight_csv_path, True, 'straight')
-generate_combined_histogram(straight_csv_path, False, 'straight')
-
-generate_combined_histogram(bend_csv_path, True, 'bend')
-generate_combined_histogram(bend_csv_path, False, 'bend')
\ No newline at end of file
+    data = {'pivot_df': pivot_df, 'colors': colors, 'labels': custom_labels, 'xlabel': 'Doublets',
+            'ylabel': f'{normalized_formatted.capitalize()} Count',
+            'title': f'{normalized_formatted.capitalize()} Histogram of {grouped_combined_formatted} Doublets for all the {type} pieces',
+            'errors': errors}
+    return draw_histogram, data, output_file_path, (12, 8)
+
+def main():
+    # All work is done in here: processes started with spawn (macOS, Windows) import this script again
+    # for render_all and the bootstrap and should only get the settings and functions
+
+    # Ensure metadata file exists
+    if not os.path.exists(metadata_file):
+        print(f"Please run format_initial.py first before making histograms!")
+        return 1
+
+    # Read the metadata file in memory
+    yaml_file = read_metadata()
+
+    # If Ready for analysis is false, return error
+    if yaml_file is None or not yaml_file['ready4analysis']:
+        print('Please check the metadata file and make sure everything in entered!')
+        return 1
+
+    # Only remake the figures whose points or settings changed since the last run,
+    # the figures are collected as render tasks and rendered together at the end
+    state = load_state(analysis_folder)
+    combined_counts = {'straight': [], 'bend': []}
+    tasks, done = [], {}
+    multipage_file = f"{analysis_folder}/histograms.pdf"
+
+    # Main loop
+    for foldername in sorted(os.listdir(rawdata_folder)):
+        input_file_path = partition_path(analysis_folder, foldername)
+
+        output_file_path = f"{analysis_folder}/{foldername}/{foldername}_bin4_points_histogram"
+
+        # Ensure input file exists
+        if not os.path.exists(input_file_path):
+            print(f"Couldn't find {foldername}, moving on..")
+            continue
+
+        # The count matrix is kept in the state, the points are only read again when they changed
+        counts_key = stage_key([input_file_path], version=stage_version)
+        if not force and is_current(state, 'get_hist_counts', foldername, counts_key):
+            counts = np.array(state['get_hist_counts'][foldername]['counts'])
+        else:
+            counts = count_matrix(read_points(analysis_folder, ['Doublet', 'class'], [foldername]))
+            mark_done(state, 'get_hist_counts', foldername, counts_key, counts=counts.tolist())
+
+        key = stage_key([input_file_path], grouped=grouped, normalized=normalized, figure_format=figure_format,
+                        version=stage_version)
+        # The multipage pdf is always made with all the figures
+        if not force and not multipage and is_current(state, 'get_hist', foldername, key, [figure_file(output_file_path, figure_format)]):
+            print(f"The histogram for {foldername} is up to date")
+        else:
+            print(f"Currently making the histogram for {foldername}")
+
+            # Make a histogram
+            tasks.append(generate_figure(counts, output_file_path))
+            done[foldername] = key
+
+        # Collect the counts of all tomograms with same bend direction, from the metadata file so changing it
+        # there doesn't need a rerun of format_inital
+        bend_direction = (yaml_file.get('bendDirection') or {}).get(foldername, 'undetermined')
+        if bend_direction in combined_counts:
+            combined_counts[bend_direction].append(counts)
+        else:
+            print(f'{foldername} is undetermined, moving on..')
+            continue
+
+    for type, type_counts in combined_counts.items():
+        outputs = [figure_file(f"{analysis_folder}/Combined_histogram_{mode}_{type}", figure_format)
+                   for mode in ['grouped', 'single']]
+        if not type_counts:
+            # No tomograms (left) with this bend direction, remove the combined histograms of earlier runs
+            for mode in ['grouped', 'single']:
+                for extension in set(extension for extension, dpi in figure_formats.values()):
+                    old_file = f"{analysis_folder}/Combined_histogram_{mode}_{type}.{extension}"
+                    if os.path.exists(old_file):
+                        print(f"Removing {old_file}, there are no {type} tomograms")
+                        os.remove(old_file)
+            state.get('get_hist', {}).pop(f'combined_{type}', None)
+            continue
+        counts = np.stack(type_counts)
+
+        # The combined histograms only change when the counts of the tomograms in them or the settings changed
+        key = stage_key(counts=counts.tolist(), normalized=normalized, figure_format=figure_format,
+                        n_resamples=n_resamples, confidence=confidence, version=stage_version)
+        if not force and not multipage and is_current(state, 'get_hist', f'combined_{type}', key, outputs):
+            print(f"The combined histograms for the {type} tomograms are up to date")
+            continue
+
+        # Generate combined histograms
+        tasks.append(generate_combined_histogram(counts, True, type))
+        tasks.append(generate_combined_histogram(counts, False, type))
+        done[f'combined_{type}'] = key
+
+    # Render all figures at once, on jobs processes
+    render_all(tasks, figure_format, jobs, multipage_file)
+    for target, key in done.items():
+        mark_done(state, 'get_hist', target, key)
+    print(f"Made {len(tasks)} histograms" + (f" in {multipage_file}" if multipage else ''))
+
+    save_state(analysis_folder, state)
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
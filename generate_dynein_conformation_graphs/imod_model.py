@@ -0,0 +1,65 @@
+import numpy as np
+
+# IMOD binary model (V1.2), all big endian, see https://bio3d.colorado.edu/imod/doc/binspec.html
+# The chunk walking in read_model is the same as read_model in relion_classes_to_mod/relion_classes_to_mod_files.py.
+# Every folder of this repository is used on its own, so it is copied here instead of imported:
+# keep the two the same when changing either one
+MODEL_HEADER = np.dtype([('name', 'S128'), ('xmax', '>i4'), ('ymax', '>i4'), ('zmax', '>i4'),
+                         ('objsize', '>i4'), ('flags', '>u4'), ('drawmode', '>i4'), ('mousemode', '>i4'),
+                         ('blacklevel', '>i4'), ('whitelevel', '>i4'), ('offset', '>f4', 3), ('scale', '>f4', 3),
+                         ('object', '>i4'), ('contour', '>i4'), ('point', '>i4'), ('res', '>i4'), ('thresh', '>i4'),
+                         ('pixsize', '>f4'), ('units', '>i4'), ('csum', '>i4'),
+                         ('alpha', '>f4'), ('beta', '>f4'), ('gamma', '>f4')])
+OBJECT_HEADER = np.dtype([('name', 'S64'), ('extra', '>u4', 16), ('contsize', '>i4'), ('flags', '>u4'),
+                          ('axis', '>i4'), ('drawmode', '>i4'), ('color', '>f4', 3), ('pdrawsize', '>i4'),
+                          ('symbol', 'u1'), ('symsize', 'u1'), ('linewidth2', 'u1'), ('linewidth', 'u1'),
+                          ('linesty', 'u1'), ('symflags', 'u1'), ('sympad', 'u1'), ('trans', 'u1'),
+                          ('meshsize', '>i4'), ('surfsize', '>i4')])
+CONTOUR_HEADER = np.dtype([('psize', '>i4'), ('flags', '>u4'), ('time', '>i4'), ('surf', '>i4')])
+MESH_HEADER = np.dtype([('vsize', '>i4'), ('lsize', '>i4'), ('flags', '>u4'), ('time', '>i2'), ('surf', '>i2')])
+
+def read_model(filename):
+    # read the objects of an IMOD binary model: [(object header, [contour points, ...]), ...]
+    # copied in relion_classes_to_mod_files.py and generate_dynein_conformation_graphs/imod_model.py, keep both the same
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'IMOD':
+        raise ValueError(f'{filename} is not an IMOD model')
+    offset = 8 + MODEL_HEADER.itemsize
+    objects = []
+    while offset < len(data):
+        chunk = data[offset:offset+4]
+        offset += 4
+        if chunk == b'IEOF':
+            break
+        elif chunk == b'OBJT':
+            objects.append((np.frombuffer(data, OBJECT_HEADER, 1, offset)[0], []))
+            offset += OBJECT_HEADER.itemsize
+        elif chunk == b'CONT':
+            psize = int(np.frombuffer(data, CONTOUR_HEADER, 1, offset)[0]['psize'])
+            offset += CONTOUR_HEADER.itemsize
+            objects[-1][1].append(np.frombuffer(data, '>f4', 3*psize, offset).reshape(-1, 3))
+            offset += 12*psize
+        elif chunk == b'MESH':
+            mesh = np.frombuffer(data, MESH_HEADER, 1, offset)[0]
+            offset += MESH_HEADER.itemsize + 12*int(mesh['vsize']) + 4*int(mesh['lsize'])
+        else: # all other chunks start with their size
+            offset += 4 + int(np.frombuffer(data, '>i4', 1, offset)[0])
+    return objects
+
+def read_model_points(model_file):
+    """
+    Read all points of an IMOD .mod file, replaces model2point -contour.
+    Returns three arrays: the object and contour number of every point (both starting at 1,
+    contours are numbered within their object like model2point does) and the XYZ coordinates (n, 3)
+    """
+    objects, contours, points = [], [], []
+    for object_nr, (header, object_contours) in enumerate(read_model(model_file), start=1):
+        for contour_nr, contour_points in enumerate(object_contours, start=1):
+            points.append(contour_points)
+            objects.append(np.full(len(contour_points), object_nr))
+            contours.append(np.full(len(contour_points), contour_nr))
+
+    if not points:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros((0, 3), np.float32)
+    return np.concatenate(objects), np.concatenate(contours), np.concatenate(points).astype(np.float32)
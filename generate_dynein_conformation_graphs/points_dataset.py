@@ -0,0 +1,52 @@
+import os
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from build_state import file_mode
+
+# All points of all tomograms in one parquet dataset in the results folder, partitioned by tomogram:
+# Results/points/tomogram=<name>/points.parquet with the columns Point, Contour, X, Y, Z, Doublet, class
+# and the metadata of the tomogram (firstDoublet, clockDirection, bendDirection)
+points_folder = 'points'
+
+# The tomogram names are strings, without this pyarrow reads a folder like tomogram=001 as the number 1
+partitioning = ds.partitioning(pa.schema([('tomogram', pa.string())]), flavor='hive')
+
+def partition_path(analysis_folder, tomogram):
+    return f"{analysis_folder}/{points_folder}/tomogram={tomogram}/points.parquet"
+
+def write_partition(df, analysis_folder, tomogram):
+    # Write to a temporary file first so an interrupted run never leaves a broken partition,
+    # files starting with a . are skipped when reading the dataset
+    path = partition_path(analysis_folder, tomogram)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.parquet')
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.chmod(tmp_path, file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+def read_points(analysis_folder, columns=None, tomograms=None):
+    """
+    Read the points dataset, only the given columns (None for all) and tomograms (None for all).
+    The tomogram name is in the 'tomogram' column
+    """
+    tomograms = [tomogram for tomogram in (tomograms if tomograms is not None else list_tomograms(analysis_folder))
+                 if os.path.exists(partition_path(analysis_folder, tomogram))]
+    if not tomograms:
+        return pd.DataFrame(columns=columns if columns is not None else [])
+    # Only the parquet files of the requested tomograms are opened
+    return pd.read_parquet(f"{analysis_folder}/{points_folder}", columns=columns, partitioning=partitioning,
+                           filters=[('tomogram', 'in', tomograms)])
+
+def list_tomograms(analysis_folder):
+    folder = f"{analysis_folder}/{points_folder}"
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(folder) if name.startswith('tomogram='))
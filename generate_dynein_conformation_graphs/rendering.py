@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # only files are written, no windows
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+
+# Output of the figures: file extension and dpi (None for vector formats)
+# preview: quick low resolution png, png: the 600 dpi png's as before, pdf/svg: vector figures for publication
+# and multipage: all figures of a script in one pdf
+figure_formats = {'preview': ('png', 100),
+                  'png': ('png', 600),
+                  'pdf': ('pdf', None),
+                  'svg': ('svg', None),
+                  'multipage': ('pdf', None)}
+
+# One figure per size is reused for every render in a process, so memory use stays flat
+_figures = {}
+
+def get_figure(figsize):
+    fig = _figures.get(figsize)
+    if fig is None:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        _figures[figsize] = fig
+    fig.clear()
+    return fig
+
+def figure_file(path, figure_format='png'):
+    # File name of a figure, path without extension
+    return f"{path}.{figure_formats[figure_format][0]}"
+
+def draw_class_table(fig, colors, column_labels):
+    # The class table of format_inital: a colored cell per point and a column per doublet
+    ax = fig.add_subplot()
+
+    # Hide axes
+    ax.xaxis.set_visible(False)
+    ax.yaxis.set_visible(False)
+    ax.set_frame_on(False)
+
+    # Create the table
+    table = ax.table(cellColours=colors,
+                     colLabels=column_labels,
+                     cellLoc='center',
+                     loc='center',
+                     colWidths=[0.07 for i in range(len(column_labels))])
+
+    # Adjust the font size
+    table.auto_set_font_size(True)
+
+    # Scale the table
+    table.scale(0.6, 0.35)
+
+def draw_histogram(fig, pivot_df, colors, labels, xlabel, ylabel, title, errors=None):
+    # Bars per doublet (group) with a bar per class, pivot_df has the doublets as index and the classes as columns.
+    # errors is None or the lower and upper bounds of the error bars, two tables like pivot_df
+    ax = fig.add_subplot()
+
+    # Define bar width and positions
+    bar_width = 0.2
+    indices = np.arange(pivot_df.shape[0])
+
+    # Plot each class as subcolumns
+    for i, (class_label, color) in enumerate(zip(pivot_df.columns, colors)):
+        if errors is not None:
+            # Distances from the top of the bar, a percentile interval doesn't always contain the bar
+            lower, upper = errors[0][class_label], errors[1][class_label]
+            yerr = np.clip([pivot_df[class_label] - lower, upper - pivot_df[class_label]], 0, None)
+        else:
+            yerr = None
+        ax.bar(indices + i * bar_width, pivot_df[class_label], bar_width, label=labels[class_label], color=color,
+               yerr=yerr, capsize=3)
+
+    # Customizing the plot
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.set_xticks(indices + bar_width)
+    ax.set_xticklabels(pivot_df.index)
+    ax.legend()
+
+def render(draw, data, path, figure_format='png', figsize=(6.4, 4.8)):
+    # Draw one figure with draw(fig, **data) and save it, path without extension. Returns the file name
+    extension, dpi = figure_formats[figure_format]
+    fig = get_figure(figsize)
+    draw(fig, **data)
+    output = figure_file(path, figure_format)
+    fig.savefig(output, dpi=dpi)
+    fig.clear()
+    return output
+
+def render_all(tasks, figure_format='png', jobs=1, multipage_file=None):
+    """
+    Render a list of figures, every task is (draw, data, path, figsize) as for render().
+    The figures are rendered on a process pool of jobs processes, or with the multipage format
+    all go as pages into multipage_file. Returns the files written
+    """
+    if not tasks:
+        return []
+    if figure_format == 'multipage':
+        with PdfPages(multipage_file) as pdf:
+            for draw, data, path, figsize in tasks:
+                fig = get_figure(figsize)
+                draw(fig, **data)
+                pdf.savefig(fig)
+                fig.clear()
+        return [multipage_file]
+    if jobs == 1:
+        return [render(draw, data, path, figure_format, figsize) for draw, data, path, figsize in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(render, draw, data, path, figure_format, figsize) for draw, data, path, figsize in tasks]
+        return [future.result() for future in futures]
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert per-tilt alignments between IMOD (.xf/.tlt), EMAN2 (tlt_params), AreTomo (.aln)
+and RELION5 (per-tilt star columns).
+
+The alignments of any number of tilt series are held in one structured array
+(ALIGNMENT_DTYPE) with a row per tilt, in IMOD form: the 2x2 matrix A and shift d
+of the .xf (aligned = A * raw + d), the tilt angle and the x tilt. All conversions
+work on the whole array at once.
+
+Conventions, as used by aretomo3 -OutImod 1 and imodxf2emanjson:
+* A is the rotation (and magnification) by the AreTomo tilt axis angle ROT:
+  A = GMAG * [[cos ROT, sin ROT], [-sin ROT, cos ROT]]
+* the AreTomo shifts (TX, TY), EMAN2 (dx, dy) and RELION5 shifts (in pixels) are all
+  the shift before rotation: -A^-1 * d
+* EMAN2 z_rot = -ROT and y_tilt = -tilt, RELION5 rlnTomoZRot = ROT and rlnTomoYTilt = tilt
+"""
+
+import numpy as np
+
+ALIGNMENT_DTYPE = np.dtype([
+    ('series', 'i4'), #index of the tilt series the tilt belongs to
+    ('a11', 'f8'), ('a12', 'f8'), ('a21', 'f8'), ('a22', 'f8'), #IMOD xf matrix
+    ('dx', 'f8'), ('dy', 'f8'), #IMOD xf shift in pixels
+    ('tilt', 'f8'), #tilt angle in degrees
+    ('x_tilt', 'f8'), #x tilt in degrees, 0 for aretomo
+])
+ALN_COLUMNS = ['SEC', 'ROT', 'GMAG', 'TX', 'TY', 'SMEAN', 'SFIT', 'SCALE', 'BASE', 'TILT']
+RELION_COLUMNS = ['rlnTomoXTilt', 'rlnTomoYTilt', 'rlnTomoZRot', 'rlnTomoXShiftAngst', 'rlnTomoYShiftAngst']
+
+def empty_alignments(n_tilts, series=0):
+    ali = np.zeros(n_tilts, dtype=ALIGNMENT_DTYPE)
+    ali['series'] = series
+    ali['a11'] = ali['a22'] = 1.0
+    return ali
+
+def concatenate(alignments): #one array for many tilt series, renumbering the series in order
+    alignments = [np.array(ali, dtype=ALIGNMENT_DTYPE) for ali in alignments]
+    for i, ali in enumerate(alignments):
+        ali['series'] = i
+    return np.concatenate(alignments) if alignments else empty_alignments(0)
+
+def split(ali): #back to one array per tilt series
+    bounds = np.flatnonzero(np.diff(ali['series'])) + 1
+    return np.split(ali, bounds)
+
+def inverse_shifts(ali):
+    """
+    Shift before rotation, -A^-1 * d, with the closed form inverse of the 2x2 matrices.
+    Returns two arrays: x and y shift in pixels
+    """
+    det = ali['a11'] * ali['a22'] - ali['a12'] * ali['a21']
+    shift_x = -(ali['a22'] * ali['dx'] - ali['a12'] * ali['dy']) / det
+    shift_y = -(ali['a11'] * ali['dy'] - ali['a21'] * ali['dx']) / det
+    return shift_x, shift_y
+
+def rotation_alignments(rot, shift_x, shift_y, tilt, x_tilt=0.0, mag=1.0, series=0):
+    """
+    Alignments from the tilt axis angle (degrees), shifts before rotation (pixels) and tilt angles.
+    """
+    rot = np.radians(np.asarray(rot, dtype=float))
+    ali = empty_alignments(len(rot), series)
+    cos, sin = mag * np.cos(rot), mag * np.sin(rot)
+    ali['a11'], ali['a12'], ali['a21'], ali['a22'] = cos, sin, -sin, cos
+    #d = -A * shift
+    ali['dx'] = -(ali['a11'] * shift_x + ali['a12'] * shift_y)
+    ali['dy'] = -(ali['a21'] * shift_x + ali['a22'] * shift_y)
+    ali['tilt'] = tilt
+    ali['x_tilt'] = x_tilt
+    return ali
+
+def tilt_axis_angle(ali): #AreTomo ROT in degrees
+    return np.degrees(np.arctan2(ali['a12'], ali['a11']))
+
+def from_imod(xf, tlt, series=0):
+    xf = np.asarray(xf, dtype=float).reshape(-1, 6)
+    ali = empty_alignments(len(xf), series)
+    for i, name in enumerate(['a11', 'a12', 'a21', 'a22', 'dx', 'dy']):
+        ali[name] = xf[:, i]
+    ali['tilt'] = tlt
+    return ali
+
+def to_imod(ali): #returns the xf (n, 6) and tlt (n,) arrays
+    xf = np.stack([ali[name] for name in ['a11', 'a12', 'a21', 'a22', 'dx', 'dy']], axis=-1)
+    return xf, ali['tilt'].copy()
+
+def from_eman(tlt_params, series=0): #tlt_params columns: dx, dy, z_rot, y_tilt, x_tilt
+    tlt_params = np.asarray(tlt_params, dtype=float).reshape(-1, 5)
+    return rotation_alignments(-tlt_params[:, 2], tlt_params[:, 0], tlt_params[:, 1],
+                               -tlt_params[:, 3], tlt_params[:, 4], series=series)
+
+def to_eman(ali): #returns tlt_params (n, 5): dx, dy, z_rot, y_tilt, x_tilt
+    dx, dy = inverse_shifts(ali)
+    return np.stack([dx, dy, -tilt_axis_angle(ali), -ali['tilt'], ali['x_tilt']], axis=-1)
+
+def from_aretomo(aln, series=0): #aln rows with the ALN_COLUMNS
+    aln = np.asarray(aln, dtype=float).reshape(-1, len(ALN_COLUMNS))
+    col = {name: aln[:, i] for i, name in enumerate(ALN_COLUMNS)}
+    return rotation_alignments(col['ROT'], col['TX'], col['TY'], col['TILT'], mag=col['GMAG'], series=series)
+
+def to_aretomo(ali): #returns aln rows (n, 10) with the ALN_COLUMNS, per tilt series SEC counts from 0
+    tx, ty = inverse_shifts(ali)
+    sec = np.arange(len(ali)) - np.searchsorted(ali['series'], ali['series']) if len(ali) else np.zeros(0)
+    gmag = np.sqrt(np.abs(ali['a11'] * ali['a22'] - ali['a12'] * ali['a21']))
+    ones, zeros = np.ones(len(ali)), np.zeros(len(ali))
+    return np.stack([sec, tilt_axis_angle(ali), gmag, tx, ty, ones, ones, ones, zeros, ali['tilt']], axis=-1)
+
+def from_relion(columns, apix, series=0): #columns: dict (or DataFrame) with the RELION_COLUMNS
+    return rotation_alignments(np.asarray(columns['rlnTomoZRot'], dtype=float),
+                               np.asarray(columns['rlnTomoXShiftAngst'], dtype=float) / apix,
+                               np.asarray(columns['rlnTomoYShiftAngst'], dtype=float) / apix,
+                               columns['rlnTomoYTilt'], columns['rlnTomoXTilt'], series=series)
+
+def to_relion(ali, apix): #returns a dict with the RELION_COLUMNS, shifts in angstrom
+    shift_x, shift_y = inverse_shifts(ali)
+    return {
+        'rlnTomoXTilt': ali['x_tilt'].copy(),
+        'rlnTomoYTilt': ali['tilt'].copy(),
+        'rlnTomoZRot': tilt_axis_angle(ali),
+        'rlnTomoXShiftAngst': shift_x * apix,
+        'rlnTomoYShiftAngst': shift_y * apix,
+    }
+
+def read_imod(xf_file, tlt_file, series=0):
+    return from_imod(np.loadtxt(xf_file, ndmin=2), np.loadtxt(tlt_file, ndmin=1), series)
+
+def write_imod(ali, xf_file, tlt_file):
+    xf, tlt = to_imod(ali)
+    np.savetxt(xf_file, xf, fmt='%12.7f %12.7f %12.7f %12.7f %12.3f %12.3f')
+    np.savetxt(tlt_file, tlt, fmt='%.2f')
+
+def read_aretomo(aln_file, series=0): #only the global alignment, the local alignment at the end is ignored
+    rows = []
+    with open(aln_file, 'r') as f:
+        for line in f:
+            if line.startswith('# Local Alignment'):
+                break
+            if line.strip() and not line.startswith('#'):
+                rows.append([float(i) for i in line.split()[:len(ALN_COLUMNS)]])
+    return from_aretomo(rows, series)
+
+def mrc_size(mrc_file): #nx, ny of the images in an mrc file, from its header
+    with open(mrc_file, 'rb') as f:
+        header = f.read(1024)
+    byte_order = '>' if header[212] == 0x11 else '<' #machine stamp, 0x11 for big endian files
+    nx, ny = np.frombuffer(header, dtype=byte_order + 'i4', count=2)
+    return int(nx), int(ny)
+
+def write_aretomo(ali, aln_file, nx, ny): #nx, ny: size of the raw tilt images in pixels (see mrc_size), aretomo reads it from the RawSize line
+    if nx <= 0 or ny <= 0:
+        raise ValueError(f"the image size must be positive, got {nx} x {ny}")
+    with open(aln_file, 'w') as f:
+        f.write('# AreTomo Alignment / Priims bprmMn \n')
+        f.write(f'# RawSize = {nx} {ny} {len(ali)}\n')
+        f.write('# NumPatches = 0\n')
+        f.write('# ' + ' '.join(f'{name:>7s}' for name in ALN_COLUMNS) + '\n')
+        np.savetxt(f, to_aretomo(ali), fmt='%5d %9.4f %8.5f %9.3f %9.3f %7.2f %7.2f %6.2f %6.2f %8.2f')
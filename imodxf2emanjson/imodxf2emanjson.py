@@ -6,46 +6,73 @@ Created on Fri Oct  3 13:06:55 2025
 @author: M. S. C. Gravett
 """
 
-from EMAN2 import *
+import os
+import re
+import glob
+import json
+import tempfile
+import time
+import argparse
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
+import alignment_formats
 
 def convert_to_hdf(tilt_name): #write out mrc in hdf format for eman2
-    Path('tiltseries').mkdir(parents=True, exist_ok=True) #make directory in eman style structure
+    from EMAN2 import EMData #imported here as loading EMAN2 is slow and only needed for this step
+    pathlib.Path('tiltseries').mkdir(parents=True, exist_ok=True) #make directory in eman style structure
     tiltseries = EMData(tilt_name) #open mrc
     tilt_name = tilt_name.rsplit('/',1)[-1].rsplit('.',1)[0] #get name
     new_name = f'{tilt_name}.hdf'
     #path = tilt_name.replace(f'{name_core}.mrc','') #path to file
     tiltseries.write_image(f'tiltseries/{new_name}') #write image
 
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16} #mrc mode -> data type
+
+def read_mrc_header(mrc_name): #get dimensions, data type, pixel size and start of the data from the mrc header
+    with open(mrc_name, 'rb') as f:
+        header = f.read(1024)
+    byte_order = '>' if header[212] == 0x11 else '<' #machine stamp, 0x11 is big endian
+    nx, ny, nz, mode = np.frombuffer(header, dtype=f'{byte_order}i4', count=4)
+    mx = np.frombuffer(header, dtype=f'{byte_order}i4', count=1, offset=28)[0] #sampling along x
+    cella_x = np.frombuffer(header, dtype=f'{byte_order}f4', count=1, offset=40)[0] #cell size along x in angstrom
+    nsymbt = np.frombuffer(header, dtype=f'{byte_order}i4', count=1, offset=92)[0] #size of the extended header
+    dtype = np.dtype(MRC_MODES[int(mode)]).newbyteorder(byte_order)
+    apix = float(cella_x / mx) if mx > 0 else 1.0
+    return (int(nx), int(ny), int(nz)), dtype, apix, 1024 + int(nsymbt)
+
+def convert_to_hdf_streaming(tilt_name, binning=1): #write out mrc in hdf format for eman2, one tilt at a time
+    import h5py #only needed for the streaming conversion
+    pathlib.Path('tiltseries').mkdir(parents=True, exist_ok=True) #make directory in eman style structure
+    (nx, ny, nz), dtype, apix, offset = read_mrc_header(tilt_name)
+    bx, by = nx // binning, ny // binning #binned dimensions, edges that don't fill a bin are cropped
+    new_name = tilt_name.rsplit('/',1)[-1].rsplit('.',1)[0] + '.hdf'
+    with h5py.File(f'tiltseries/{new_name}', 'w') as hdf: #same layout as EMAN2 writes, a single 3D image
+        images = hdf.create_group('MDF/images')
+        images.attrs['imageid_max'] = np.int32(0)
+        image = images.create_group('0')
+        for axis in 'xyz':
+            image.attrs[f'EMAN.apix_{axis}'] = np.float32(apix * binning)
+        data = image.create_dataset('image', shape=(nz, by, bx), dtype=np.float32, chunks=(1, by, bx))
+        for z in range(nz):
+            #map only this tilt, so at most one tilt is in memory
+            tilt = np.memmap(tilt_name, dtype=dtype, mode='r', offset=offset + z * nx * ny * dtype.itemsize, shape=(ny, nx))
+            if binning > 1:
+                tilt = tilt[:by*binning, :bx*binning].reshape(by, binning, bx, binning).mean(axis=(1, 3))
+            data[z] = tilt
+            del tilt
+
 
 def readxf(xf_file, tlt_file):
     # EMAN translates then rotates, IMOD rotates then translates
     # R(x+dx, y+dy) = R(x, y) + R(dx, dy)
     # IMOD (dx, dy) is the rotated EMAN (dx, dy)
     #logic from tomoguide for aretomo to relion and alistair burt's emanjson2imodxf
-    xf_array = np.loadtxt(xf_file) #load imod xf file
-    tlt_array = np.loadtxt(tlt_file) #load imod tlt file
-    A11 = xf_array[:,0] #column 1 in xf 0,0 of 2D rot matrix
-    A12 = xf_array[:,1] #column 2 in xf 0,1 of 2D rot matrix
-    A21 = xf_array[:,2] #column 3 in xf 1,0 of 2D rot matrix
-    A22 = xf_array[:,3] #column 4 in xf 1,1 of 2D rot matrix
-    dx_imod = xf_array[:,4] #column 5 in xf, shift in x
-    dy_imod = xf_array[:,5] #column 6 in xf shift in y
-    rotation_matrices = np.zeros([len(A11),3,3]) #make empty array to put xf file data into 3x3 transformation matrices
-    rotation_matrices[:, 0, 0] = A11
-    rotation_matrices[:, 0, 1] = A12
-    rotation_matrices[:, 1, 0] = A21
-    rotation_matrices[:, 1, 1] = A22
-    rotation_matrices[:, 0, 2] = dx_imod
-    rotation_matrices[:, 1, 2] = dy_imod
-    rotation_matrices[:, 2, 2] = [1.0]*len(A11)
-    T_inv = np.linalg.inv(rotation_matrices) #invert matrices to find shift in eman
-    dx_eman = T_inv[:,0,2]
-    dy_eman = T_inv[:,1,2]
-    z_rot = -1*np.degrees(np.arctan2(A12,A11))#find refined tilt axis in degrees
-    y_tilt = -1*tlt_array #list of tilt angles from tlt
-    x_tilt = [0.0]*len(A11) #xtilt is 0 for aretomo3 imod output
+    #the conversion itself lives in alignment_formats, shared with the aretomo and relion formats
+    alignments = alignment_formats.read_imod(xf_file, tlt_file) #load imod xf and tlt file
+    tlt_params = alignment_formats.to_eman(alignments) #closed form inverse of the xf matrices, x tilt is 0 for aretomo3 imod output
+    dx_eman, dy_eman, z_rot, y_tilt, x_tilt = tlt_params.T
     return dx_eman, dy_eman, z_rot, y_tilt, x_tilt
 
 def get_defocus(defocus_file): #get defocus values from aretomo3 ctf.txt file
@@ -55,25 +82,122 @@ def get_defocus(defocus_file): #get defocus values from aretomo3 ctf.txt file
     av_df = (df1+df2)/2
     return av_df*10**-4
 
+def file_mode(path): #mode of the file that is replaced, or 0666 minus the umask for a new file
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def write_info_json(json_name, values): #set keys in an eman2 json like js_open_dict does, without needing EMAN2
+    try:
+        with open(json_name, 'r') as f:
+            info = json.load(f) #keep what is already in there
+    except FileNotFoundError:
+        info = {}
+    for key, value in values.items():
+        info[key] = value.tolist() if isinstance(value, np.ndarray) else value #eman2 stores arrays as lists
+    jss = json.dumps(info, indent=0, sort_keys=True)
+    jss = re.sub(r"\n\s*(\-?[0-9.]+)", r"\1", jss) #put numbers on one line, same as eman2 does
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(json_name) or '.', suffix='.tmp', delete=False) as f:
+        f.write(jss)
+    os.chmod(f.name, file_mode(json_name)) #tempfile makes 0600 files, keep the mode js_open_dict would give
+    os.replace(f.name, json_name) #never leave a half written json
+
 def imodxf2emanjson(xf_file, tlt_file, unbinned_pix,tilt_name,defocus_file=''): #Takes imod xf and tilt file to make eman2 json
-    Path('info').mkdir(parents=True, exist_ok=True) #make directory in eman style structure
+    pathlib.Path('info').mkdir(parents=True, exist_ok=True) #make directory in eman style structure
     tilt_name = tilt_name.rsplit('/',1)[-1].rsplit('.',1)[0]
     json_name = f'info/{tilt_name}_info.json' #name of json
-    tomo_json = js_open_dict(json_name) #open empty json
+    tomo_json = {} #keys to set in the json
     dx, dy, z_rot, y_tilt, x_tilt = readxf(xf_file, tlt_file) #get data from xf file
-    json = np.stack((dx, dy, z_rot, y_tilt, x_tilt), axis=-1) #xf data in corect format
+    tlt_params = np.stack((dx, dy, z_rot, y_tilt, x_tilt), axis=-1) #xf data in corect format
     tomo_json['apix_unbin'] = unbinned_pix #pixel size angstroms
     tomo_json['tlt_file']=f"tiltseries/{tilt_name}.hdf" #tilt series path
-    tomo_json['tlt_params'] = json #write xf data to json tlt_params
+    tomo_json['tlt_params'] = tlt_params #write xf data to json tlt_params
     tomo_json['ali_loss'] = [1]*len(dx) #just set to arbitrary value
     tomo_json['phase'] = [10.0]*len(dx) #not sure if this is correct just copied values in tutorials
     if len(defocus_file)>0: 
         defocus = get_defocus(defocus_file) #gets defocus from
         tomo_json['defocus'] = defocus
+    write_info_json(json_name, tomo_json)
+
+def find_tilt_series(folder):
+    """
+    Find all tilt series in folder that have a NAME.mrc, NAME.xf and NAME.tlt file.
+    Returns a dict: {name: (mrc, xf, tlt, ctf)}, ctf is '' when there is no NAME_CTF.txt
+    """
+    tilt_series = {}
+    for xf_file in sorted(glob.glob(os.path.join(folder, '*.xf'))):
+        name = xf_file[:-len('.xf')]
+        files = (f'{name}.mrc', xf_file, f'{name}.tlt')
+        if not all(os.path.exists(i) for i in files):
+            print(f"Skipping {os.path.basename(name)}: missing {', '.join(i for i in files if not os.path.exists(i))}")
+            continue
+        ctf_file = f'{name}_CTF.txt'
+        tilt_series[os.path.basename(name)] = files + (ctf_file if os.path.exists(ctf_file) else '',)
+    return tilt_series
+
+def process_tilt_series(files, unbinned_pix, write_hdf=True, write_json=True, defocus=True, stream=False, binning=1):
+    """
+    Run the hdf conversion and json generation for one tilt series.
+    Returns a dict with the time (s) each step took, or the error if one failed
+    """
+    tilt_name, xf_file, tlt_file, ctf_file = files
+    timings = {}
+    try:
+        if write_hdf:
+            start = time.perf_counter()
+            if stream or binning > 1:
+                convert_to_hdf_streaming(tilt_name, binning)
+            else:
+                convert_to_hdf(tilt_name)
+            timings['hdf'] = time.perf_counter() - start
+        if write_json:
+            start = time.perf_counter()
+            imodxf2emanjson(xf_file, tlt_file, unbinned_pix, tilt_name, ctf_file if defocus else '')
+            timings['json'] = time.perf_counter() - start
+    except Exception as e:
+        timings['error'] = str(e)
+    return timings
 
-unbinned_pix = 2.21 #unbinned pixel size in angstrom
-tilt_name ='path/to/tilt/series/tomo1.mrc' #tilseries
-convert_to_hdf(tilt_name) #convert tilt teries from mrc to hdf
-imodxf2emanjson('tomo1.xf', 'tomo1.tlt', unbinned_pix,tilt_name,'tomo1_CTF.txt') #xf file and tilt file from imod, ctf file from aretomo not required
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import all tilt series in a folder (NAME.mrc, NAME.xf and NAME.tlt from aretomo3 -OutImod 1, optionally NAME_CTF.txt) "
+                    "into the EMAN2 project in the current directory."
+    )
+    parser.add_argument("folder", nargs='?', default='.', help="Folder with the tilt series files (default: current directory)")
+    parser.add_argument("--apix", type=float, required=True, help="Unbinned pixel size in angstrom")
+    parser.add_argument("--tomo", nargs='+', default=None, help="Only import these tilt series (NAME)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of tilt series to import in parallel")
+    parser.add_argument("--no-hdf", action="store_true", help="Don't convert the tilt series to hdf")
+    parser.add_argument("--no-json", action="store_true", help="Don't write the info json files")
+    parser.add_argument("--no-defocus", action="store_true", help="Don't add the defocus from the _CTF.txt files")
+    parser.add_argument("--stream", action="store_true",
+                        help="Convert the tilt series to hdf one tilt at a time instead of loading the whole tilt series, needs h5py")
+    parser.add_argument("--bin", type=int, default=1, help="Bin the tilt series by this factor while converting to hdf (implies --stream)")
+    args = parser.parse_args()
 
+    tilt_series = find_tilt_series(args.folder)
+    if args.tomo is not None:
+        tilt_series = {name: files for name, files in tilt_series.items() if name in args.tomo}
+    if not tilt_series:
+        print(f"No tilt series found in {args.folder}")
+        exit(1)
+    print(f"Importing {len(tilt_series)} tilt series")
 
+    process = partial(process_tilt_series, unbinned_pix=args.apix, write_hdf=not args.no_hdf,
+                      write_json=not args.no_json, defocus=not args.no_defocus, stream=args.stream, binning=args.bin)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = pool.map(process, tilt_series.values())
+        failed = []
+        for name, timings in zip(tilt_series, results):
+            if 'error' in timings:
+                print(f"{name}: failed: {timings['error']}")
+                failed.append(name)
+            else:
+                print(f"{name}: " + ', '.join(f"{step} {seconds:.1f}s" for step, seconds in timings.items()))
+    print(f"Imported {len(tilt_series) - len(failed)} of {len(tilt_series)} tilt series in {time.perf_counter() - start:.1f}s")
+    if failed:
+        exit(1)
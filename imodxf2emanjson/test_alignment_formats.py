@@ -0,0 +1,90 @@
+import numpy as np
+import alignment_formats
+from imodxf2emanjson import readxf
+
+# Round trips between the alignment formats and readxf against the old 3x3 inverse. Run with python -m pytest
+
+def random_alignments(n_series=20, n_tilts=61, mag=1.0, seed=0):
+    # tilt series with a random tilt axis angle, random shifts and tilts, and a small jitter of the axis per tilt
+    rng = np.random.default_rng(seed)
+    alignments = []
+    for series in range(n_series):
+        rot = rng.uniform(-180, 180) + rng.normal(0, 0.5, n_tilts)
+        shift_x, shift_y = rng.uniform(-200, 200, (2, n_tilts))
+        tilt = np.linspace(-60, 60, n_tilts) + rng.normal(0, 0.1, n_tilts)
+        alignments.append(alignment_formats.rotation_alignments(rot, shift_x, shift_y, tilt, mag=mag, series=series))
+    return alignment_formats.concatenate(alignments)
+
+def assert_same_imod(ali, other, atol=1e-9):
+    xf, tlt = alignment_formats.to_imod(ali)
+    other_xf, other_tlt = alignment_formats.to_imod(other)
+    np.testing.assert_allclose(other_xf, xf, rtol=0, atol=atol)
+    np.testing.assert_allclose(other_tlt, tlt, rtol=0, atol=atol)
+    np.testing.assert_array_equal(other['series'], ali['series'])
+
+def test_imod_eman_imod():
+    ali = random_alignments()
+    back = alignment_formats.from_eman(alignment_formats.to_eman(ali))
+    back['series'] = ali['series']
+    assert_same_imod(ali, back)
+
+def test_imod_relion_imod():
+    ali = random_alignments()
+    back = alignment_formats.from_relion(alignment_formats.to_relion(ali, apix=1.35), apix=1.35)
+    back['series'] = ali['series']
+    assert_same_imod(ali, back)
+
+def test_imod_aretomo_imod():
+    ali = random_alignments(mag=1.0)
+    back = alignment_formats.concatenate(alignment_formats.from_aretomo(aln)
+                                         for aln in np.split(alignment_formats.to_aretomo(ali), 20))
+    assert_same_imod(ali, back)
+
+def test_aretomo_keeps_magnification():
+    ali = random_alignments(mag=1.02)
+    back = alignment_formats.from_aretomo(alignment_formats.to_aretomo(ali))
+    back['series'] = ali['series']
+    assert_same_imod(ali, back)
+
+def old_readxf(xf_file, tlt_file):
+    # readxf before alignment_formats: the xf as 3x3 matrices, inverted with np.linalg.inv
+    xf_array = np.loadtxt(xf_file)
+    tlt_array = np.loadtxt(tlt_file)
+    rotation_matrices = np.zeros([len(xf_array), 3, 3])
+    rotation_matrices[:, 0, 0] = xf_array[:, 0]
+    rotation_matrices[:, 0, 1] = xf_array[:, 1]
+    rotation_matrices[:, 1, 0] = xf_array[:, 2]
+    rotation_matrices[:, 1, 1] = xf_array[:, 3]
+    rotation_matrices[:, 0, 2] = xf_array[:, 4]
+    rotation_matrices[:, 1, 2] = xf_array[:, 5]
+    rotation_matrices[:, 2, 2] = 1.0
+    T_inv = np.linalg.inv(rotation_matrices)
+    z_rot = -1 * np.degrees(np.arctan2(xf_array[:, 1], xf_array[:, 0]))
+    return T_inv[:, 0, 2], T_inv[:, 1, 2], z_rot, -1 * tlt_array, np.zeros(len(xf_array))
+
+def test_readxf_matches_3x3_inverse(tmp_path):
+    xf_file, tlt_file = str(tmp_path / 'ts.xf'), str(tmp_path / 'ts.tlt')
+    alignment_formats.write_imod(random_alignments(n_series=1, mag=0.98), xf_file, tlt_file)
+    for new, old in zip(readxf(xf_file, tlt_file), old_readxf(xf_file, tlt_file)):
+        np.testing.assert_allclose(new, old, rtol=0, atol=1e-10)
+
+def test_write_read_aretomo(tmp_path):
+    aln_file = str(tmp_path / 'ts.aln')
+    ali = random_alignments(n_series=1)
+    alignment_formats.write_aretomo(ali, aln_file, 4096, 4096)
+    with open(aln_file) as f:
+        assert '# RawSize = 4096 4096 61\n' in f.readlines()
+    aln = alignment_formats.to_aretomo(ali)
+    back = alignment_formats.to_aretomo(alignment_formats.read_aretomo(aln_file))
+    # half of the last printed decimal of every column: SEC ROT GMAG TX TY SMEAN SFIT SCALE BASE TILT
+    precision = 0.5 * 10.0 ** -np.array([0, 4, 5, 3, 3, 2, 2, 2, 2, 2]) + 1e-9
+    assert np.all(np.abs(back - aln) <= precision)
+
+def test_mrc_size(tmp_path):
+    for byte_order, stamp in (('<', b'\x44\x44'), ('>', b'\x11\x11')):
+        header = bytearray(1024)
+        header[:12] = np.array([4096, 3072, 61], dtype=byte_order + 'i4').tobytes()
+        header[212:214] = stamp
+        mrc_file = tmp_path / f'ts{byte_order == ">"}.mrc'
+        mrc_file.write_bytes(bytes(header))
+        assert alignment_formats.mrc_size(str(mrc_file)) == (4096, 3072)
@@ -1,52 +1,400 @@
+import os
+import glob
+import csv
+from datetime import datetime
+from io import StringIO
+from itertools import chain, islice, takewhile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import starfile
+import numpy as np
 import pandas as pd
 import argparse
 
-def scale_coordinates(star_filename, pixel_sizes):
-    # Load the STAR file
-    data = starfile.read(star_filename)
-    # Check if the required columns exist
-    required_columns = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnDetectorPixelSize']
-    if not all(col in data.columns for col in required_columns):
-        print(data.columns)
-        print(f"Missing columns: {set(required_columns)-set(data.columns)}")
-        raise ValueError(f"A RELION4 STAR file must contain the columns: {required_columns}")
+REQUIRED_COLUMNS = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnDetectorPixelSize']
+CENTERED_COLUMNS = ['rlnCenteredCoordinateXAngst', 'rlnCenteredCoordinateYAngst', 'rlnCenteredCoordinateZAngst']
+SCORE_COLUMN = 'rlnLCCmax'
+COLUMN_CHANGE = {
+    "rlnCoordinateX": "rlnCenteredCoordinateXAngst",
+    "rlnCoordinateY": "rlnCenteredCoordinateYAngst",
+    "rlnCoordinateZ": "rlnCenteredCoordinateZAngst",
+    "rlnMicrographName": "rlnTomoName",
+    "rlnDetectorPixelSize": "rlnTomoTiltSeriesPixelSize",
+}
 
+def check_columns(columns):
     # Check if the required columns exist
+    if not all(col in columns for col in REQUIRED_COLUMNS):
+        print(columns)
+        print(f"Missing columns: {set(REQUIRED_COLUMNS)-set(columns)}")
+        raise ValueError(f"A RELION4 STAR file must contain the columns: {REQUIRED_COLUMNS}")
+
+def read_dimensions_table(table_filename):
+    """
+    Read a text file with a line per tomogram: name, X, Y and Z dimensions in pixels.
+    Returns a dict: {tomo_name: (x, y, z)}
+    """
+    dimensions = {}
+    with open(table_filename, 'r') as f:
+        for line in f:
+            cols = line.split()
+            if len(cols) == 0 or cols[0].startswith('#'):
+                continue
+            dimensions[cols[0]] = tuple(float(i) for i in cols[1:4])
+    return dimensions
+
+def read_mrc_dimensions(mrc_filename):
+    # nx, ny and nz are the first 3 words of the MRC header, byte 212 marks big endian files
+    with open(mrc_filename, 'rb') as f:
+        header = f.read(1024)
+    byte_order = '>' if header[212] == 0x11 else '<'
+    return tuple(float(i) for i in np.frombuffer(header, dtype=f'{byte_order}i4', count=3))
+
+def read_tomogram_dimensions(tomogram_folder):
+    """
+    Get the dimensions of all tomograms (.mrc and .rec) in a folder from their MRC headers.
+    Returns a dict: {tomo_name: (x, y, z)}
+    """
+    dimensions = {}
+    for tomogram in glob.glob(os.path.join(tomogram_folder, '*.mrc')) + glob.glob(os.path.join(tomogram_folder, '*.rec')):
+        dimensions[os.path.basename(tomogram)] = read_mrc_dimensions(tomogram)
+    return dimensions
+
+def find_dimensions(tomo_name, dimensions):
+    # match on the full name, the file name, or the file name without extension
+    tomo_name = str(tomo_name)
+    for key in (tomo_name, os.path.basename(tomo_name), os.path.splitext(os.path.basename(tomo_name))[0]):
+        if key in dimensions:
+            return dimensions[key]
+    stems = {os.path.splitext(key)[0]: value for key, value in dimensions.items()}
+    return stems.get(os.path.splitext(os.path.basename(tomo_name))[0])
+
+def tomogram_centers(data, pixel_sizes):
+    """
+    Center of the tomogram of every particle, for a single (x, y, z) size or a dict of sizes per rlnMicrographName.
+    """
+    if not isinstance(pixel_sizes, dict):
+        return np.asarray(pixel_sizes, dtype=float) / 2
+    if 'rlnMicrographName' not in data.columns:
+        raise ValueError("Converting with tomogram dimensions per tomogram requires a rlnMicrographName column")
+    # look up every tomogram once, then broadcast to the particles
+    codes, names = pd.factorize(data['rlnMicrographName'])
+    sizes = [find_dimensions(name, pixel_sizes) for name in names]
+    missing = [name for name, size in zip(names, sizes) if size is None]
+    if missing:
+        raise ValueError(f"No dimensions found for tomograms: {missing}")
+    return np.asarray(sizes, dtype=float).reshape(-1, 3)[codes] / 2
+
+def center_and_scale(data, pixel_sizes):
     # same guestimate pytom-match-pick uses
-    center_x = pixel_sizes[0] / 2
-    center_y = pixel_sizes[1] / 2
-    center_z = pixel_sizes[2] / 2
+    centers = tomogram_centers(data, pixel_sizes)
+    center_x = centers[..., 0]
+    center_y = centers[..., 1]
+    center_z = centers[..., 2]
     # Multiply each coordinate by the corresponding pixel size and detector pixel size
     data['rlnCoordinateX'] = (data['rlnCoordinateX'] - center_x) * data['rlnDetectorPixelSize']
     data['rlnCoordinateY'] = (data['rlnCoordinateY'] - center_y) * data['rlnDetectorPixelSize']
     data['rlnCoordinateZ'] = (data['rlnCoordinateZ'] - center_z) * data['rlnDetectorPixelSize']
+    return data.rename(columns=COLUMN_CHANGE)
 
-    column_change = {
-        "rlnCoordinateX": "rlnCenteredCoordinateXAngst",
-        "rlnCoordinateY": "rlnCenteredCoordinateYAngst",
-        "rlnCoordinateZ": "rlnCenteredCoordinateZAngst",
-        "rlnMicrographName": "rlnTomoName",
-        "rlnDetectorPixelSize": "rlnTomoTiltSeriesPixelSize",
-    }
-    data = data.rename(columns=column_change)
+def duplicate_mask(coordinates, tomograms, scores, min_distance):
+    """
+    Find near-duplicate picks: within every tomogram, picks closer than min_distance to a
+    higher scoring pick are removed, starting from the highest scoring pick.
+    Equal scores are resolved in file order.
+    Returns a boolean array that is True for the picks to keep.
+    """
+    # scipy is only needed when removing duplicates
+    from scipy.spatial import cKDTree
+
+    coordinates = np.asarray(coordinates, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    keep = np.ones(len(coordinates), dtype=bool)
+    codes = pd.factorize(np.asarray(tomograms))[0]
+    by_tomogram = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[by_tomogram])) + 1
+    for idx in np.split(by_tomogram, bounds):
+        pairs = cKDTree(coordinates[idx]).query_pairs(min_distance, output_type='ndarray')
+        if len(pairs) == 0:
+            continue
+        # rank the picks on score, then point every pair from the better to the worse pick
+        order = np.lexsort((np.arange(len(idx)), -scores[idx]))
+        rank = np.empty(len(idx), dtype=int)
+        rank[order] = np.arange(len(idx))
+        swap = rank[pairs[:, 0]] > rank[pairs[:, 1]]
+        better = np.where(swap, pairs[:, 1], pairs[:, 0])
+        worse = np.where(swap, pairs[:, 0], pairs[:, 1])
+        by_better = np.argsort(rank[better], kind='stable')
+        better, worse = better[by_better], worse[by_better]
+        starts = np.flatnonzero(np.r_[True, better[1:] != better[:-1]])
+        ends = np.r_[starts[1:], len(better)]
+        removed = np.zeros(len(idx), dtype=bool)
+        # only picks that are themselves kept remove their neighbours
+        for start, end in zip(starts, ends):
+            if not removed[better[start]]:
+                removed[worse[start:end]] = True
+        keep[idx[removed]] = False
+    return keep
+
+def particle_scores(data):
+    # without a score all picks are equal and the first one in the file is kept
+    if SCORE_COLUMN in data.columns:
+        return data[SCORE_COLUMN].to_numpy(dtype=float)
+    return np.zeros(len(data))
+
+def scale_coordinates(star_filename, pixel_sizes, min_distance=None, sidecar=False):
+    # Load the STAR file
+    data = starfile.read(star_filename)
+    check_columns(data.columns)
+    data = center_and_scale(data, pixel_sizes)
+
+    # Remove near-duplicate picks
+    if min_distance:
+        tomograms = data['rlnTomoName'] if 'rlnTomoName' in data.columns else np.zeros(len(data))
+        keep = duplicate_mask(data[CENTERED_COLUMNS], tomograms, particle_scores(data), min_distance)
+        print(f"Removed {np.sum(~keep)} of {len(data)} particles closer than {min_distance} Å to a better pick")
+        data = data[keep]
 
     # Write the updated data to a new STAR file
     output_filename = star_filename.replace('.star', '_rf5.star')
-    starfile.write({"particles":data}, output_filename, overwrite=True)
+    write_particles(output_filename, [data], sidecar)
 
     print(f"RELION5 coordinates written to: {output_filename}")
 
+def read_loop_chunks(star_filename, chunk_size, string_columns=()):
+    """
+    Read the first loop block of a STAR file in DataFrames of at most chunk_size rows.
+    Rows are split the same way starfile.read does, but not yet converted to numbers.
+    Columns in string_columns are kept as text.
+    """
+    with open(star_filename, 'r') as f:
+        lines = (line.strip() for line in f)
+        # skip to the loop header
+        for line in lines:
+            if line.startswith('loop_'):
+                break
+        columns = []
+        data = iter(())
+        for line in lines:
+            if not line.startswith('_'):
+                # the loop ends at the end of the file or the next data block
+                data = takewhile(lambda row: not row.startswith('data_'), chain([line], lines))
+                break
+            columns.append(line.split()[0][1:])
+        dtype = {columns.index(col): str for col in string_columns}
+
+        while batch := list(islice(data, chunk_size)):
+            rows = [row for row in batch if row]
+            if rows:
+                yield parse_loop_rows(rows, columns, dtype)
+
+def parse_loop_rows(rows, columns, dtype=None):
+    # split loop rows into a DataFrame with the same options starfile.read uses
+    chunk = pd.read_csv(StringIO('\n'.join(rows).replace("'", '"') + '\n'),
+                        delimiter=r'\s+', header=None, comment='#', dtype=dtype,
+                        keep_default_na=False, na_values=['nan', 'NaN', '<NA>'], engine='c')
+    chunk.columns = columns
+    return chunk
+
+def infer_column_kinds(star_filename, chunk_size):
+    """
+    First pass over the loop block, finding the type each column gets when the whole
+    block is numericised at once: 'int', 'float' or 'str'.
+    """
+    kinds = {}
+    for chunk in read_loop_chunks(star_filename, chunk_size):
+        for col in chunk.columns:
+            try:
+                values = pd.to_numeric(chunk[col])
+                kind = 'int' if pd.api.types.is_integer_dtype(values) else 'float'
+            except ValueError:
+                kind = 'str'
+            previous = kinds.get(col, 'int')
+            kinds[col] = max(previous, kind, key=['int', 'float', 'str'].index)
+    return kinds
+
+def read_converted_chunks(star_filename, pixel_sizes, chunk_size, kinds):
+    # chunks of the loop block with the column types of kinds, centred and scaled
+    string_columns = [col for col, kind in kinds.items() if kind == 'str']
+    for chunk in read_loop_chunks(star_filename, chunk_size, string_columns):
+        for col, kind in kinds.items():
+            if kind != 'str':
+                chunk[col] = pd.to_numeric(chunk[col]).astype(kind)
+        yield center_and_scale(chunk, pixel_sizes)
+
+def scale_coordinates_chunked(star_filename, pixel_sizes, chunk_size=100000, min_distance=None, sidecar=False):
+    """
+    Same conversion as scale_coordinates, but streaming the particles in chunks of chunk_size
+    rows, so memory use doesn't depend on the number of particles.
+    The column types are decided on a first pass over the file, so the written STAR file is
+    identical to the one of scale_coordinates.
+    With a min_distance, an extra pass collects only the coordinates, tomograms and scores
+    to find the near-duplicate picks.
+    """
+    kinds = infer_column_kinds(star_filename, chunk_size)
+    check_columns(list(kinds))
+
+    keep = None
+    if min_distance:
+        coordinates, tomograms, scores = [], [], []
+        for chunk in read_converted_chunks(star_filename, pixel_sizes, chunk_size, kinds):
+            coordinates.append(chunk[CENTERED_COLUMNS].to_numpy(dtype=float))
+            tomograms.append(chunk['rlnTomoName'].to_numpy() if 'rlnTomoName' in chunk.columns else np.zeros(len(chunk)))
+            scores.append(particle_scores(chunk))
+        keep = duplicate_mask(np.concatenate(coordinates), np.concatenate(tomograms), np.concatenate(scores), min_distance)
+        print(f"Removed {np.sum(~keep)} of {len(keep)} particles closer than {min_distance} Å to a better pick")
+
+    def kept_chunks():
+        n_read = 0
+        for chunk in read_converted_chunks(star_filename, pixel_sizes, chunk_size, kinds):
+            if keep is not None:
+                chunk_keep = keep[n_read:n_read + len(chunk)]
+                n_read += len(chunk)
+                chunk = chunk[chunk_keep]
+            yield chunk
+
+    output_filename = star_filename.replace('.star', '_rf5.star')
+    n_particles = write_particles(output_filename, kept_chunks(), sidecar)
+
+    print(f"RELION5 coordinates of {n_particles} particles written to: {output_filename}")
+
+def sidecar_filename(star_filename):
+    return os.path.splitext(star_filename)[0] + '.feather'
+
+def loop_header(block_name, columns):
+    # data block and loop header as starfile.write gives them
+    return [f'data_{block_name}', '', 'loop_'] + [f'_{col} #{i}' for i, col in enumerate(columns, 1)]
+
+def loop_rows(chunk):
+    # rows of a loop block formatted like starfile.write does: tab separated, floats with 6 decimals
+    # and strings that are empty or contain spaces in double quotes
+    chunk = chunk.copy()
+    for col in chunk.columns:
+        if not pd.api.types.is_numeric_dtype(chunk[col]):
+            chunk[col] = chunk[col].map(lambda x: f'"{x}"' if isinstance(x, str) and (' ' in x or not x) else x)
+    return chunk.to_csv(sep='\t', header=False, index=False, float_format='%.6f', na_rep='<NA>',
+                        quoting=csv.QUOTE_NONE).splitlines()
+
+def write_particles(output_filename, chunks, sidecar=False):
+    """
+    Write DataFrames of converted particles as one loop block to a STAR file, formatted as starfile.write does.
+    With sidecar, a Feather file holding the values exactly as starfile.read gives them
+    is written next to it, for fast reading with read_particles.
+    Returns the number of particles written.
+    """
+    if sidecar:
+        # pyarrow is only needed for the sidecar
+        import pyarrow as pa
+        sidecar_writer = sidecar_schema = None
+    n_particles = n_chunks = 0
+    with open(output_filename, 'w') as f:
+        f.write(f"# Created by convert_rel4_rel5.py at {datetime.now():%H:%M:%S on %d/%m/%Y}\n\n\n")
+        for chunk in chunks:
+            # only the first chunk writes the loop header
+            rows = loop_rows(chunk)
+            lines = loop_header('particles', chunk.columns) + rows if n_chunks == 0 else rows
+            f.writelines(line + '\n' for line in lines)
+            n_particles += len(chunk)
+            n_chunks += 1
+
+            if sidecar and len(chunk) > 0:
+                # read the written rows back so the sidecar holds what the STAR file holds
+                string_columns = [col for col in chunk.columns if not pd.api.types.is_numeric_dtype(chunk[col])]
+                written = parse_loop_rows(rows, list(chunk.columns),
+                                          {list(chunk.columns).index(col): str for col in string_columns})
+                for col in chunk.columns:
+                    if col not in string_columns:
+                        written[col] = pd.to_numeric(written[col]).astype(chunk[col].dtype)
+                if sidecar_writer is None:
+                    table = pa.Table.from_pandas(written, preserve_index=False)
+                    sidecar_schema = table.schema
+                    sidecar_writer = pa.ipc.new_file(sidecar_filename(output_filename), sidecar_schema)
+                else:
+                    table = pa.Table.from_pandas(written, schema=sidecar_schema, preserve_index=False)
+                sidecar_writer.write_table(table)
+        f.write('\n\n')
+    # closed after the STAR file, so a complete sidecar is never older than its STAR file
+    if sidecar and sidecar_writer is not None:
+        sidecar_writer.close()
+    return n_particles
+
+def read_particles(star_filename):
+    """
+    Read the particles of a converted STAR file, from its Feather sidecar when that
+    is at least as new as the STAR file and from the STAR file otherwise.
+    """
+    sidecar = sidecar_filename(star_filename)
+    if os.path.exists(sidecar) and os.stat(sidecar).st_mtime_ns >= os.stat(star_filename).st_mtime_ns:
+        return pd.read_feather(sidecar)
+    return starfile.read(star_filename)
+
+def convert_star_file(star_filename, pixel_sizes, chunk_size=None, min_distance=None, sidecar=False):
+    """
+    Convert one STAR file, returns True if that worked.
+    pixel_sizes is either one (x, y, z) size for all tomograms or a dict of sizes per tomogram.
+    """
+    try:
+        if chunk_size:
+            scale_coordinates_chunked(star_filename, pixel_sizes, chunk_size, min_distance, sidecar)
+        else:
+            scale_coordinates(star_filename, pixel_sizes, min_distance, sidecar)
+        return True
+    except Exception as e:
+        print(f"Failed to convert {star_filename}: {e}")
+        return False
+
+def convert_star_files(star_filenames, pixel_sizes, chunk_size=None, jobs=1, min_distance=None, sidecar=False):
+    """
+    Convert many STAR files, spread over jobs worker processes.
+    """
+    convert = partial(convert_star_file, pixel_sizes=pixel_sizes, chunk_size=chunk_size,
+                      min_distance=min_distance, sidecar=sidecar)
+    if jobs > 1 and len(star_filenames) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(convert, star_filenames))
+    else:
+        results = [convert(star_filename) for star_filename in star_filenames]
+    failed = [star_filename for star_filename, result in zip(star_filenames, results) if not result]
+    if len(star_filenames) > 1:
+        print(f"Converted {len(star_filenames) - len(failed)} of {len(star_filenames)} STAR files")
+    for star_filename in failed:
+        print(f"  failed: {star_filename}")
+    return failed
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Convert a RELION4 particle .star file to a RELION5 star file. This requires input on the dimensions of the tomogram used for picking."
+        description="Convert RELION4 particle .star files to RELION5 star files. This requires input on the dimensions of the tomograms used for picking, "
+                    "either one X Y Z size for all tomograms, a table per tomogram (--dimensions) or a folder with the tomograms (--tomograms)."
     )
-    parser.add_argument("starfile", type=str, help="Path to the input STAR file")
-    parser.add_argument("pixel_x", type=float, help="Number of pixels in X dimension")
-    parser.add_argument("pixel_y", type=float, help="Number of pixels in Y dimension")
-    parser.add_argument("pixel_z", type=float, help="Number of pixels in Z dimension")
+    parser.add_argument("starfile", type=str, nargs='+',
+                        help="Path(s) to the input STAR file(s), followed by the number of pixels in X, Y and Z when all tomograms have the same size")
+    parser.add_argument("--dimensions", type=str, default=None,
+                        help="Text file with a line per tomogram: rlnMicrographName, number of pixels in X, Y and Z")
+    parser.add_argument("--tomograms", type=str, default=None,
+                        help="Folder with the tomograms (.mrc/.rec) used for picking, the dimensions are read from their headers")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Stream the particles in chunks of this many rows instead of loading the whole file, for very large particle sets")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of STAR files to convert in parallel")
+    parser.add_argument("--min-distance", type=float, default=None,
+                        help="Remove picks closer than this (in Å) to a higher scoring (rlnLCCmax) pick in the same tomogram")
+    parser.add_argument("--feather", action="store_true",
+                        help="Also write the particles to a binary .feather file next to the _rf5.star file, for fast reading with read_particles")
 
     args = parser.parse_args()
-    pixel_sizes = (args.pixel_x, args.pixel_y, args.pixel_z)
+    star_filenames = args.starfile
+    if args.dimensions:
+        pixel_sizes = read_dimensions_table(args.dimensions)
+    elif args.tomograms:
+        pixel_sizes = read_tomogram_dimensions(args.tomograms)
+    else:
+        if len(star_filenames) < 4:
+            parser.error("give the number of pixels in X, Y and Z after the STAR file(s), or use --dimensions or --tomograms")
+        try:
+            pixel_sizes = tuple(float(i) for i in star_filenames[-3:])
+        except ValueError:
+            parser.error("the last three arguments should be the number of pixels in X, Y and Z")
+        star_filenames = star_filenames[:-3]
 
-    scale_coordinates(args.starfile, pixel_sizes)
+    failed = convert_star_files(star_filenames, pixel_sizes, args.chunk_size, args.jobs, args.min_distance, args.feather)
+    if failed:
+        exit(1)
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pandas as pd
+import starfile
+from pandas.testing import assert_frame_equal
+from convert_rel4_rel5 import convert_star_file, read_particles, sidecar_filename
+
+# Round trip of the converted particles: the STAR file and the Feather sidecar have to give the same values,
+# and converting in memory or in chunks has to give the same STAR file. Run with python -m pytest
+
+def write_rel4_particles(filename, n_particles=50, seed=0):
+    rng = np.random.default_rng(seed)
+    starfile.write(pd.DataFrame({
+        'rlnMicrographName': [f'tomo{i % 3}.mrc' for i in range(n_particles)],
+        'rlnCoordinateX': rng.uniform(0, 1000, n_particles),
+        'rlnCoordinateY': rng.uniform(0, 1000, n_particles),
+        'rlnCoordinateZ': rng.uniform(0, 300, n_particles),
+        'rlnAngleRot': rng.uniform(-180, 180, n_particles),
+        'rlnAngleTilt': rng.uniform(0, 180, n_particles),
+        'rlnAnglePsi': rng.uniform(-180, 180, n_particles),
+        'rlnLCCmax': rng.uniform(0, 1, n_particles),
+        'rlnClassNumber': rng.integers(1, 4, n_particles),
+        'rlnDetectorPixelSize': np.full(n_particles, 1.35),
+        'rlnComment': [f'pick {i}' if i % 2 else 'pick' for i in range(n_particles)],
+    }), filename, overwrite=True)
+
+def convert(tmp_path, name, chunk_size):
+    star_filename = str(tmp_path / f'{name}.star')
+    write_rel4_particles(star_filename)
+    assert convert_star_file(star_filename, (1000, 1000, 300), chunk_size=chunk_size, sidecar=True)
+    return str(tmp_path / f'{name}_rf5.star')
+
+def test_sidecar_matches_star(tmp_path):
+    for name, chunk_size in (('memory', None), ('chunked', 7)):
+        output = convert(tmp_path, name, chunk_size)
+        assert os.path.exists(sidecar_filename(output))
+        assert_frame_equal(starfile.read(output), read_particles(output), check_exact=True)
+
+def test_chunked_matches_memory(tmp_path):
+    with open(convert(tmp_path, 'memory', None), 'rb') as f:
+        memory = f.read().split(b'\n', 1)
+    with open(convert(tmp_path, 'chunked', 7), 'rb') as f:
+        chunked = f.read().split(b'\n', 1)
+    # only the first line, with the time it was written, can differ
+    assert memory[1] == chunked[1]
+
+def test_read_particles_without_sidecar(tmp_path):
+    output = convert(tmp_path, 'memory', None)
+    os.remove(sidecar_filename(output))
+    assert_frame_equal(read_particles(output), starfile.read(output), check_exact=True)
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # Script to go from an relion classification star file to a set of .mod files for visualisation
 # WARNING: this is all very experimental, assumes:
-# -no more than 10 classes
 # -We can find all required info in the relion star file
-# -imod is installed and point2model is findable
+# -imod is only needed to check the .mod files against point2model (--validate)
 
 import argparse
-from itertools import chain
+import colorsys
+import io
+import os
+import shutil
 import subprocess
+import tempfile
+import numpy as np
 RLN_COLS = {'_rlnCoordinateX': 'x',
             '_rlnCoordinateY': 'y',
             '_rlnCoordinateZ': 'z',
@@ -15,6 +19,7 @@ RLN_COLS = {'_rlnCoordinateX': 'x',
             '_rlnTomoName': 'tomoname',
             '_rlnClassNumber': 'class_nr'
             }
+RLN_DTYPES = {'x': 'f8', 'y': 'f8', 'z': 'f8', 'contour': 'i8', 'tomoname': object, 'class_nr': 'i8'}
 # Grab the MPL tabel colors
 MPL_COLORS = [(31, 119, 180),
               (255,127,14),
@@ -26,66 +31,325 @@ MPL_COLORS = [(31, 119, 180),
               (127, 127, 127),
               (188, 189, 34),
               (23, 190, 207)]
+COORDINATE_FORMAT = '%6d%6d%12.2f%12.2f%12.2f\n'
+INDEX_SUFFIX = '.tomo_index.npz'
+# IMOD binary model (V1.2), all big endian, see https://bio3d.colorado.edu/imod/doc/binspec.html
+MODEL_HEADER = np.dtype([('name', 'S128'), ('xmax', '>i4'), ('ymax', '>i4'), ('zmax', '>i4'),
+                         ('objsize', '>i4'), ('flags', '>u4'), ('drawmode', '>i4'), ('mousemode', '>i4'),
+                         ('blacklevel', '>i4'), ('whitelevel', '>i4'), ('offset', '>f4', 3), ('scale', '>f4', 3),
+                         ('object', '>i4'), ('contour', '>i4'), ('point', '>i4'), ('res', '>i4'), ('thresh', '>i4'),
+                         ('pixsize', '>f4'), ('units', '>i4'), ('csum', '>i4'),
+                         ('alpha', '>f4'), ('beta', '>f4'), ('gamma', '>f4')])
+OBJECT_HEADER = np.dtype([('name', 'S64'), ('extra', '>u4', 16), ('contsize', '>i4'), ('flags', '>u4'),
+                          ('axis', '>i4'), ('drawmode', '>i4'), ('color', '>f4', 3), ('pdrawsize', '>i4'),
+                          ('symbol', 'u1'), ('symsize', 'u1'), ('linewidth2', 'u1'), ('linewidth', 'u1'),
+                          ('linesty', 'u1'), ('symflags', 'u1'), ('sympad', 'u1'), ('trans', 'u1'),
+                          ('meshsize', '>i4'), ('surfsize', '>i4')])
+CONTOUR_HEADER = np.dtype([('psize', '>i4'), ('flags', '>u4'), ('time', '>i4'), ('surf', '>i4')])
+MESH_HEADER = np.dtype([('vsize', '>i4'), ('lsize', '>i4'), ('flags', '>u4'), ('time', '>i2'), ('surf', '>i2')])
+ICONT_WILD = 1 << 4 # contour not in one z plane
+IMOD_OBJFLAG_OPEN = 1 << 3
+IMOD_OBJFLAG_SCAT = 1 << 9
 
-def main(starfile, binning=1):
-    # output structure: {tomoname: (class, helix_id, x, y, z)}
-    outputs = {}
-    cols = {i : None for i in RLN_COLS.values()}
-    min_class, max_class = 1, 1
-    with open(starfile, 'r') as f:
-        iterator = (line for line in f)
-        # find all columns
-        while any(i is None for i in cols.values()):
-            try:
-                line = next(iterator)
-            except StopIteration:
-                break
-            line = line.strip().split()
-            if len(line) > 0 and line[0] in RLN_COLS:
-                cols[RLN_COLS[line[0]]] = int(line[1].strip('#'))-1
-        # find start of data
-        line = next(iterator)
-        while line.startswith('_'):
-            line = next(iterator)
-        for line in chain([line], iterator):
-            split = line.strip().split()
-            if len(split) == 0:
-                continue
-            tomoname = split[cols['tomoname']]
-            contour = split[cols['contour']]
-            class_nr = int(split[cols['class_nr']])
-            x = split[cols['x']]
-            y = split[cols['y']]
-            z = split[cols['z']]
-            min_class = min(min_class, class_nr)
-            max_class = max(max_class, class_nr)
-            particles = outputs.get(tomoname, list())
-            # contours start at 0 while classes start a 1, make both start at 1
-            particles.append((class_nr, int(contour)+1, float(x)/binning, float(y)/binning, float(z)/binning))
-            outputs[tomoname] = particles
-
-    # Start writing text files
-    conversion_list = []
-    for output_name, output_data in outputs.items():
-        output_name += '_coordinates.txt'
-        with open(output_name, 'w+') as f:
-            f.writelines([f'{i[0]:6d}{i[1]:6d}{i[2]:12.2f}{i[3]:12.2f}{i[4]:12.2f}\n' 
-                for i in output_data])
-        conversion_list.append(output_name)
-    # Convert text to mdocs
-    used_colors = [MPL_COLORS[i] for i in range(0, max_class-min_class+1)]
-    for name in conversion_list:
-        outname = name.split('.')[0]+'.mod'
-        cmd = ['point2model','-sphere', '5']
-        for c in used_colors:
-            cmd += ["-color", f"{c[0]},{c[1]},{c[2]}"] 
-        cmd += [f"{name}", f"{outname}"]
-        print(f"Converting {name} to {outname}")
-        subprocess.run(cmd)
+def class_colors(n_classes):
+    # MPL colors first, after that spread the hues with the golden ratio so neighbouring classes differ
+    colors = MPL_COLORS[:n_classes]
+    for i in range(n_classes - len(colors)):
+        r, g, b = colorsys.hsv_to_rgb((i * 0.618033988749895) % 1, 0.75, 0.9)
+        colors.append((int(r*255), int(g*255), int(b*255)))
+    return colors
+
+def find_columns(f):
+    # find the column numbers and the byte offset of the first data line of the loop that has all RLN_COLS
+    cols = {}
+    n_labels = 0
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            missing = [k for k, v in RLN_COLS.items() if v not in cols]
+            raise ValueError(f'Could not find {", ".join(missing)} in the star file')
+        split = line.decode().split()
+        if len(split) == 0 or split[0].startswith('#'):
+            continue
+        if split[0].startswith('data_') or split[0] == 'loop_':
+            cols, n_labels = {}, 0
+        elif split[0].startswith('_'):
+            if split[0] in RLN_COLS:
+                cols[RLN_COLS[split[0]]] = int(split[1].strip('#'))-1 if len(split) > 1 else n_labels
+            n_labels += 1
+        elif len(cols) == len(RLN_COLS):
+            return cols, offset
+
+def parse_particles(f, cols):
+    # parse particle rows from a file object into a structured array with the RLN_COLS
+    names = sorted(cols, key=cols.get) # loadtxt fills the fields in column order
+    dtype = [(name, RLN_DTYPES[name]) for name in names]
+    return np.loadtxt(f, dtype=dtype, usecols=[cols[name] for name in names], comments='#', ndmin=1)
+
+def read_particles(starfile):
+    # read the particle loop in one pass into typed columns, returns a structured array with the RLN_COLS
+    with open(starfile, 'rb') as f:
+        cols, offset = find_columns(f)
+        f.seek(offset)
+        return parse_particles(f, cols)
+
+def index_filename(starfile):
+    return starfile + INDEX_SUFFIX
+
+def file_mode(path):
+    # mode of the file that is replaced, or 0666 minus the umask for a new file,
+    # tempfile makes 0600 files which others in a shared project folder can't read
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def build_index(starfile):
+    # one pass over the particle loop storing the byte range of every run of rows from the same tomogram,
+    # a star file sorted by tomogram has one run per tomogram, otherwise a tomogram can have a run per row
+    stat = os.stat(starfile)
+    run_names, run_starts, run_ends = [], [], []
+    with open(starfile, 'rb') as f:
+        cols, offset = find_columns(f)
+        f.seek(offset)
+        tomo_col = cols['tomoname']
+        run_name = None
+        for line in f:
+            split = line.split(None, tomo_col+1)
+            if len(split) > 0 and not split[0].startswith(b'#'):
+                if split[0].startswith((b'data_', b'loop_', b'_')) or len(split) <= tomo_col:
+                    break # end of the particle loop
+                if split[tomo_col] != run_name:
+                    if run_name is not None:
+                        run_ends.append(offset)
+                    run_name = split[tomo_col]
+                    run_names.append(run_name.decode())
+                    run_starts.append(offset)
+            offset += len(line)
+        if run_name is not None:
+            run_ends.append(offset)
+    index = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'col_names': np.array(list(cols)), 'col_numbers': np.array(list(cols.values())),
+             'run_names': np.array(run_names, dtype=str), 'run_starts': np.array(run_starts, dtype=np.int64),
+             'run_ends': np.array(run_ends, dtype=np.int64)}
+    # write to a temporary file first so an interrupted run never leaves a broken index
+    directory = os.path.dirname(os.path.abspath(starfile))
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.npz')
+    except PermissionError:
+        # a star file in a folder we can't write to, use the index without keeping it
+        print(f"Can't write {index_filename(starfile)}, the index is not kept")
+        return index
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **index)
+        os.chmod(tmp_name, file_mode(index_filename(starfile)))
+        os.replace(tmp_name, index_filename(starfile))
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    return index
+
+def load_index(starfile):
+    # the index of a star file, (re)built when it is missing or the star file changed
+    stat = os.stat(starfile)
+    try:
+        with np.load(index_filename(starfile)) as data:
+            if data['size'] == stat.st_size and data['mtime_ns'] == stat.st_mtime_ns:
+                return {key: data[key] for key in data.files}
+    except (OSError, KeyError, ValueError):
+        pass
+    print(f"Indexing {starfile}")
+    return build_index(starfile)
+
+def read_tomograms(starfile, tomonames):
+    # read only the particles of the given tomograms, seeking to their byte ranges in the index
+    index = load_index(starfile)
+    cols = dict(zip(index['col_names'].tolist(), index['col_numbers'].tolist()))
+    blocks = []
+    with open(starfile, 'rb') as f:
+        for tomoname in tomonames:
+            runs = np.flatnonzero(index['run_names'] == tomoname)
+            if len(runs) == 0:
+                print(f"{tomoname} not found in {starfile}")
+            for start, end in zip(index['run_starts'][runs], index['run_ends'][runs]):
+                f.seek(start)
+                blocks.append(f.read(end - start).rstrip(b'\n') + b'\n')
+    if not blocks:
+        return np.zeros(0, dtype=[(name, RLN_DTYPES[name]) for name in sorted(cols, key=cols.get)])
+    return parse_particles(io.BytesIO(b''.join(blocks)), cols)
+
+def group_by_tomogram(particles):
+    # {tomoname: particle rows}, rows keep the order of the star file
+    names, inverse = np.unique(particles['tomoname'].astype(str), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    # leave the tomoname out of the sorted copy, moving python objects around is slow
+    particles = particles[[name for name in particles.dtype.names if name != 'tomoname']][order]
+    return dict(zip(names, np.split(particles, np.cumsum(np.bincount(inverse, minlength=len(names)))[:-1])))
+
+def write_coordinates(filename, particles, binning=1):
+    # contours start at 0 while classes start a 1, make both start at 1
+    columns = np.column_stack([particles['class_nr'], particles['contour']+1,
+                               particles['x']/binning, particles['y']/binning, particles['z']/binning])
+    with open(filename, 'w+') as f:
+        f.write((COORDINATE_FORMAT * len(columns)) % tuple(columns.ravel().tolist()))
+
+def model_objects(particles, n_objects, binning=1):
+    # [[contour points, ...] per object], one object per class and one contour per helical tube
+    order = np.lexsort((particles['contour'], particles['class_nr'])) # stable, points keep the star file order
+    particles = particles[order]
+    points = np.column_stack([particles['x'], particles['y'], particles['z']]) / binning
+    keys = np.column_stack([particles['class_nr'], particles['contour']])
+    starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+    objects = [[] for _ in range(n_objects)]
+    for start, contour in zip(np.concatenate([[0], starts]), np.split(points, starts)):
+        if len(contour):
+            objects[keys[start, 0] - 1].append(contour)
+    return objects
+
+def write_model(filename, objects, colors, sphere_size=5):
+    # write an IMOD binary model with an object per entry in objects (lists of (n, 3) contour points)
+    all_points = [contour for contours in objects for contour in contours]
+    max_xyz = np.ceil(np.max(np.concatenate(all_points), axis=0)) if all_points else np.ones(3)
+    header = np.zeros(1, MODEL_HEADER)
+    header['name'] = b'IMOD-NewModel'
+    header['xmax'], header['ymax'], header['zmax'] = np.maximum(max_xyz, 1).astype(int)
+    header['objsize'] = len(objects)
+    header['drawmode'], header['mousemode'] = 1, 1
+    header['whitelevel'] = 255
+    header['scale'] = 1
+    header['contour'], header['point'] = -1, -1
+    header['res'], header['thresh'] = 3, 128
+    header['pixsize'] = 1
+    chunks = [b'IMODV1.2', header.tobytes()]
+    for contours, color in zip(objects, colors):
+        obj = np.zeros(1, OBJECT_HEADER)
+        obj['contsize'] = len(contours)
+        obj['drawmode'] = 1
+        obj['color'] = np.array(color) / 255
+        obj['pdrawsize'] = sphere_size
+        obj['symsize'], obj['linewidth2'], obj['linewidth'] = 3, 1, 1
+        chunks += [b'OBJT', obj.tobytes()]
+        for contour in contours:
+            cont = np.zeros(1, CONTOUR_HEADER)
+            cont['psize'] = len(contour)
+            cont['flags'] = ICONT_WILD if np.ptp(contour[:, 2]) > 0 else 0
+            chunks += [b'CONT', cont.tobytes(), contour.astype('>f4').tobytes()]
+    chunks.append(b'IEOF')
+    with open(filename, 'wb') as f:
+        f.write(b''.join(chunks))
+
+def read_model(filename):
+    # read the objects of an IMOD binary model: [(object header, [contour points, ...]), ...]
+    # copied in relion_classes_to_mod_files.py and generate_dynein_conformation_graphs/imod_model.py, keep both the same
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'IMOD':
+        raise ValueError(f'{filename} is not an IMOD model')
+    offset = 8 + MODEL_HEADER.itemsize
+    objects = []
+    while offset < len(data):
+        chunk = data[offset:offset+4]
+        offset += 4
+        if chunk == b'IEOF':
+            break
+        elif chunk == b'OBJT':
+            objects.append((np.frombuffer(data, OBJECT_HEADER, 1, offset)[0], []))
+            offset += OBJECT_HEADER.itemsize
+        elif chunk == b'CONT':
+            psize = int(np.frombuffer(data, CONTOUR_HEADER, 1, offset)[0]['psize'])
+            offset += CONTOUR_HEADER.itemsize
+            objects[-1][1].append(np.frombuffer(data, '>f4', 3*psize, offset).reshape(-1, 3))
+            offset += 12*psize
+        elif chunk == b'MESH':
+            mesh = np.frombuffer(data, MESH_HEADER, 1, offset)[0]
+            offset += MESH_HEADER.itemsize + 12*int(mesh['vsize']) + 4*int(mesh['lsize'])
+        else: # all other chunks start with their size
+            offset += 4 + int(np.frombuffer(data, '>i4', 1, offset)[0])
+    return objects
+
+def compare_models(reference, model, tolerance=0.01):
+    # list of differences between two IMOD models, empty when they match
+    ref_objects, objects = read_model(reference), read_model(model)
+    if len(ref_objects) > len(objects):
+        return [f'{len(ref_objects)} objects in {reference}, {len(objects)} in {model}']
+    # point2model only makes objects up to the highest class in the coordinate file, we write one per class
+    # of the star file, so the objects after those of point2model have to be empty
+    differences = [f'object {i}: {len(contours)} contours, point2model has no object {i}'
+                   for i, (_, contours) in enumerate(objects[len(ref_objects):], start=len(ref_objects)+1)
+                   if any(len(c) for c in contours)]
+    objects = objects[:len(ref_objects)]
+    for i, ((ref_obj, ref_contours), (obj, contours)) in enumerate(zip(ref_objects, objects), start=1):
+        if not np.allclose(ref_obj['color'], obj['color'], atol=1/255):
+            differences.append(f'object {i}: color {ref_obj["color"]} != {obj["color"]}')
+        if ref_obj['pdrawsize'] != obj['pdrawsize']:
+            differences.append(f'object {i}: sphere size {ref_obj["pdrawsize"]} != {obj["pdrawsize"]}')
+        if ref_obj['flags'] & (IMOD_OBJFLAG_OPEN | IMOD_OBJFLAG_SCAT) != obj['flags'] & (IMOD_OBJFLAG_OPEN | IMOD_OBJFLAG_SCAT):
+            differences.append(f'object {i}: contour type flags {ref_obj["flags"]} != {obj["flags"]}')
+        ref_contours = [c for c in ref_contours if len(c)]
+        if len(ref_contours) != len(contours):
+            differences.append(f'object {i}: {len(ref_contours)} contours != {len(contours)}')
+            continue
+        # point2model does not have to order the contours like we do
+        key = lambda c: (len(c), *np.round(c[0], 1))
+        for j, (ref_contour, contour) in enumerate(zip(sorted(ref_contours, key=key), sorted(contours, key=key))):
+            if ref_contour.shape != contour.shape or not np.allclose(ref_contour, contour, atol=tolerance):
+                differences.append(f'object {i}: contour {j} points differ')
+    return differences
+
+def point2model(coordinate_file, model_file, colors, sphere_size=5):
+    cmd = ['point2model','-sphere', str(sphere_size)]
+    for c in colors:
+        cmd += ["-color", f"{c[0]},{c[1]},{c[2]}"] 
+    cmd += [f"{coordinate_file}", f"{model_file}"]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+def validate_model(model_file, particles, colors, binning=1, sphere_size=5):
+    # compare a model written by write_model with the point2model conversion of the same particles
+    with tempfile.TemporaryDirectory() as tmp:
+        coordinate_file = os.path.join(tmp, 'coordinates.txt')
+        reference = os.path.join(tmp, 'point2model.mod')
+        write_coordinates(coordinate_file, particles, binning)
+        point2model(coordinate_file, reference, colors, sphere_size)
+        differences = compare_models(reference, model_file, tolerance=0.01) # coordinates are rounded to 2 decimals in the text
+    for difference in differences:
+        print(f"  {model_file}: {difference}")
+    return len(differences) == 0
+
+def main(starfile, binning=1, sphere_size=5, validate=False, coordinates=False, tomos=None):
+    if validate and shutil.which('point2model') is None:
+        print("point2model not found, load imod to validate the .mod files")
+        validate = False
+    particles = read_tomograms(starfile, tomos) if tomos else read_particles(starfile)
+    min_class = min(1, particles['class_nr'].min(initial=1))
+    max_class = max(1, particles['class_nr'].max(initial=1))
+    used_colors = class_colors(max_class-min_class+1)
+    particles['class_nr'] -= min_class - 1 # objects are numbered from 1
+    n_failed = 0
+    for tomoname, tomo_particles in group_by_tomogram(particles).items():
+        if coordinates:
+            write_coordinates(tomoname + '_coordinates.txt', tomo_particles, binning)
+        outname = tomoname + '.mod'
+        print(f"Writing {outname}")
+        objects = model_objects(tomo_particles, len(used_colors), binning)
+        write_model(outname, objects, used_colors, sphere_size)
+        if validate and not validate_model(outname, tomo_particles, used_colors, binning, sphere_size):
+            n_failed += 1
+    if validate:
+        print(f"{n_failed} .mod files differ from point2model" if n_failed else "All .mod files match point2model")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-sf','--starfile', required=True)
     parser.add_argument('-b', '--binning', default=1, type=int, help='Binning of the tomogram associated with the final .mod')
+    parser.add_argument('--sphere', default=5, type=int, help='Sphere size of the points in the .mod')
+    parser.add_argument('--coordinates', action='store_true', help='Also write the <tomo>_coordinates.txt point2model input')
+    parser.add_argument('--validate', action='store_true', help='Check every .mod against point2model, needs imod')
+    parser.add_argument('--tomo', nargs='+', help='Only write the .mod of these tomograms (_rlnTomoName), '
+                        f'the rows are found with an index next to the star file (<starfile>{INDEX_SUFFIX}) that is built on first use')
     args = parser.parse_args()
-    main(starfile=args.starfile, binning=args.binning)
+    main(starfile=args.starfile, binning=args.binning, sphere_size=args.sphere, validate=args.validate,
+         coordinates=args.coordinates, tomos=args.tomo)